@@ -0,0 +1,298 @@
+"""Офлайн-бенчмарк health_bot: без токена и без Heroku.
+
+HTTP-слой pyTelegramBotAPI подменяется заглушкой, которая сразу отвечает как Telegram (с задержкой
+--api-latency), база - локальный Postgres из --database-url. Бенчмарк прогоняет через обработчики
+бота трассу апдейтов (/check и загрузки, /debt, /stat, /gift, /love с нажатием кнопки, /plan) и печатает
+пропускную способность, p50/p99 времени обработки и число запросов к базе на апдейт по каждой команде.
+
+С --runtime polling или asyncio те же апдейты идут не прямо в обработчики, а через рантайм бота:
+bot.polling получает их из заглушки getUpdates, AsyncRuntime - через свою очередь и пул потоков. Так
+сравнивается пропускная способность рантаймов при одинаковой нагрузке.
+
+Трасса генерируется по --seed или читается из файла (--trace), её можно сохранить (--save-trace) и
+прогонять одну и ту же до и после изменений. Данные бота в базе перед прогоном очищаются, поэтому
+--database-url должен указывать на отдельную базу.
+
+Пример:
+    createdb health_bench
+    python benchmark.py --database-url postgresql://localhost/health_bench --users 200 --days 14
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BENCH_TOKEN = '0:bench'
+DATA_TABLES = ('activity', 'user_levels', 'user_states', 'ratings', 'user_achieves', 'user_counters', 'penalties',
+               'job_runs', 'chat_stats')
+
+
+def make_trace(users, chats, days, seed):
+    """Синтетическая трасса: каждый день часть пользователей тренируется, остальные заходят за статистикой."""
+    rnd = random.Random(seed)
+    start = int(time.time()) - days * 86400
+    trace = []
+    for day in range(days):
+        for user_id in range(1, users + 1):
+            chat_id = -(user_id % chats + 1)
+            date = start + day * 86400 + rnd.randrange(6 * 3600, 23 * 3600)
+            if rnd.random() < 0.7:
+                command = '/debt' if rnd.random() < 0.1 else '/check'
+                trace.append({'user_id': user_id, 'chat_id': chat_id, 'date': date, 'command': command})
+                trace.append({'user_id': user_id, 'chat_id': chat_id, 'date': date + 60, 'command': 'photo'})
+            command = rnd.choices(['/stat', '/gift', '/love', '/plan', None], [4, 1, 1, 1, 8])[0]
+            if command is not None:
+                trace.append({'user_id': user_id, 'chat_id': chat_id, 'date': date + 120, 'command': command})
+                if command == '/love':
+                    trace.append({'user_id': user_id, 'chat_id': chat_id, 'date': date + 130, 'command': 'love_button',
+                                  'target': rnd.randrange(1, users + 1)})
+            # посторонние фото в чате, которые бот должен отбросить
+            if rnd.random() < 0.3:
+                trace.append({'user_id': user_id, 'chat_id': chat_id, 'date': date + 300, 'command': 'photo'})
+    trace.sort(key=lambda event: event['date'])
+    return trace
+
+
+def make_update(update_id, event):
+    user = {'id': event['user_id'], 'is_bot': False, 'first_name': f'Bench{event["user_id"]}',
+            'username': f'bench{event["user_id"]}'}
+    message = {'message_id': update_id, 'from': user, 'date': event['date'],
+               'chat': {'id': event['chat_id'], 'type': 'group', 'title': 'bench'}}
+    if event['command'] == 'photo':
+        message['photo'] = [{'file_id': 'bench', 'file_unique_id': 'bench', 'width': 1, 'height': 1}]
+    elif event['command'] == 'love_button':
+        return {'update_id': update_id,
+                'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': 'bench',
+                                   'data': f'love:{event["target"]}', 'message': message}}
+    else:
+        message['text'] = event['command']
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(event['command'])}]
+    return {'update_id': update_id, 'message': message}
+
+
+class FakeTelegram:
+    """Заглушка apihelper._make_request: отвечает на методы Bot API без сети и считает вызовы."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.updates = deque()  # что вернёт getUpdates
+        self.drained = threading.Event()  # getUpdates отдал всё и вернул пустой ответ
+
+    def __call__(self, token, method_name, method='get', params=None, files=None):
+        with self._lock:
+            self.calls[method_name] = self.calls.get(method_name, 0) + 1
+            self._message_id += 1
+            message_id = self._message_id
+        if self.latency:
+            time.sleep(self.latency)
+
+        params = params or {}
+        if method_name == 'getUpdates':
+            with self._lock:
+                batch = [self.updates.popleft() for _ in range(min(len(self.updates), 100))]
+            if not batch:
+                self.drained.set()
+                time.sleep(0.05)  # вместо long polling
+            return batch
+        if method_name == 'getChatMember':
+            user_id = int(params['user_id'])
+            return {'status': 'member', 'user': {'id': user_id, 'is_bot': False, 'first_name': f'Bench{user_id}',
+                                                 'username': f'bench{user_id}'}}
+        if method_name in ('sendChatAction', 'answerCallbackQuery'):
+            return True
+        if method_name == 'getMe':
+            return {'id': 0, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': int(params.get('chat_id', 0)), 'type': 'group'}}
+        if method_name == 'sendAnimation':
+            message['animation'] = {'file_id': f'animation{message_id}', 'file_unique_id': 'bench', 'width': 1,
+                                    'height': 1, 'duration': 1}
+        elif method_name == 'sendSticker':
+            message['sticker'] = {'file_id': f'sticker{message_id}', 'file_unique_id': 'bench', 'width': 1,
+                                  'height': 1, 'is_animated': False}
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+
+def reset_database(database_url):
+    import psycopg2
+
+    db_conn = psycopg2.connect(database_url, sslmode=os.environ['DATABASE_SSLMODE'])
+    db_conn.autocommit = True
+    cur = db_conn.cursor()
+    cur.execute('SELECT tablename FROM pg_tables WHERE schemaname = current_schema()')
+    existing = {row[0] for row in cur.fetchall()}
+    tables = [table for table in DATA_TABLES if table in existing]
+    if tables:
+        cur.execute(f'TRUNCATE {", ".join(tables)}')
+    db_conn.close()
+
+
+def run_polling_runtime(health_bot, fake_api, updates):
+    """Апдейты через bot.polling и его пул потоков; время - пока пул не разберёт всё полученное."""
+    bot = health_bot.bot
+    bot.threaded = True
+    fake_api.updates.extend(updates)
+    started = time.monotonic()
+    poller = threading.Thread(target=bot.polling, kwargs={'none_stop': True}, daemon=True)
+    poller.start()
+    fake_api.drained.wait()
+    while not bot.worker_pool.tasks.empty():
+        time.sleep(0.01)
+    bot.worker_pool.close()  # дожидается апдейтов, которые уже в работе
+    elapsed = time.monotonic() - started
+    bot.stop_polling()
+    poller.join()
+    return elapsed, {}
+
+
+def run_async_runtime(health_bot, updates):
+    """Апдейты через AsyncRuntime: очередь, порядок по пользователю и пул из ASYNC_WORKERS потоков."""
+    health_bot.bot.threaded = False
+    runtime = health_bot.AsyncRuntime()
+
+    async def main():
+        runtime.start()
+        dispatcher = asyncio.ensure_future(runtime.dispatcher())
+        for raw_update in updates:
+            await runtime.submit(raw_update)
+        await runtime.drain(dispatcher)
+
+    started = time.monotonic()
+    asyncio.run(main())
+    return time.monotonic() - started, runtime.stats()
+
+
+def run(args):
+    # окружение бота задаётся до импорта: health_bot читает его при загрузке модуля
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('DATABASE_SSLMODE', 'disable')
+    os.environ['HEALTH_TOKEN'] = BENCH_TOKEN
+    os.environ['DB_POOL_MAX_SIZE'] = str(max(args.concurrency, 1))
+    os.environ['ASYNC_WORKERS'] = str(max(args.concurrency, 1))
+    os.environ.setdefault('OUTBOX_GLOBAL_RATE', '1000000')  # замеряем бота, а не лимиты Telegram
+    os.environ.setdefault('OUTBOX_CHAT_RATE', '1000000')
+    os.environ.setdefault('OUTBOX_CHAT_BURST', '1000000')
+    os.environ.setdefault('LOG_FILE', 'benchmark.log')
+
+    import telebot
+    fake_api = FakeTelegram(args.api_latency / 1000)
+    telebot.apihelper._make_request = fake_api
+
+    if not args.keep_data:
+        reset_database(args.database_url)
+
+    started = time.monotonic()
+    import health_bot
+    health_bot.init_db()
+    print(f'startup {(time.monotonic() - started) * 1000:.1f} ms')
+
+    if args.trace:
+        with open(args.trace) as trace_file:
+            trace = [json.loads(line) for line in trace_file]
+    else:
+        trace = make_trace(args.users, args.chats, args.days, args.seed)
+    if args.save_trace:
+        with open(args.save_trace, 'w') as trace_file:
+            trace_file.writelines(json.dumps(event) + '\n' for event in trace)
+
+    if args.runtime != 'direct':
+        updates = [make_update(update_id, event) for update_id, event in enumerate(trace, 1)]
+        if args.runtime == 'polling':
+            elapsed, stats = run_polling_runtime(health_bot, fake_api, updates)
+        else:
+            elapsed, stats = run_async_runtime(health_bot, updates)
+        print(f'{args.runtime}: {len(trace)} updates in {elapsed:.2f}s ({len(trace) / elapsed:.1f} updates/s), '
+              f'api latency {args.api_latency} ms')
+        if stats:
+            print(f'handler p50 {stats.get("handler_latency_p50_ms")} ms, p99 {stats.get("handler_latency_p99_ms")} ms, '
+                  f'end-to-end p50 {stats.get("latency_p50_ms")} ms, p99 {stats.get("latency_p99_ms")} ms')
+        return
+
+    health_bot.bot.threaded = False
+    # запросы к базе считаются по потоку, который обрабатывает апдейт
+    local = threading.local()
+    execute = health_bot.db_engine.execute
+
+    def counted_execute(name, *params):
+        local.queries = getattr(local, 'queries', 0) + 1
+        return execute(name, *params)
+
+    health_bot.db_engine.execute = counted_execute
+
+    results = {}  # команда -> [(секунды, запросы)]
+    results_lock = threading.Lock()
+
+    def process(events):
+        for update_id, event in events:
+            update = telebot.types.Update.de_json(make_update(update_id, event))
+            local.queries = 0
+            start = time.monotonic()
+            health_bot.bot.process_new_updates([update])
+            elapsed = time.monotonic() - start
+            with results_lock:
+                results.setdefault(event['command'], []).append((elapsed, local.queries))
+
+    # апдейты одного пользователя обрабатываются по порядку в одном потоке, как в AsyncRuntime
+    shards = [[] for _ in range(max(args.concurrency, 1))]
+    for update_id, event in enumerate(trace, 1):
+        shards[event['user_id'] % len(shards)].append((update_id, event))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        list(executor.map(process, shards))
+    elapsed = time.monotonic() - started
+
+    print(f'{len(trace)} updates in {elapsed:.2f}s ({len(trace) / elapsed:.1f} updates/s), '
+          f'concurrency {len(shards)}, api latency {args.api_latency} ms')
+    print(f'{"command":<12} {"count":>7} {"p50 ms":>9} {"p99 ms":>9} {"queries":>8}')
+    total_queries = 0
+    for command, samples in sorted(results.items()):
+        latencies = np.array([sample[0] for sample in samples]) * 1000
+        queries = np.array([sample[1] for sample in samples])
+        total_queries += queries.sum()
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print(f'{command:<12} {len(samples):>7} {p50:>9.2f} {p99:>9.2f} {queries.mean():>8.2f}')
+    print(f'queries per update {total_queries / len(trace):.2f}, telegram calls {sum(fake_api.calls.values())} '
+          f'{dict(sorted(fake_api.calls.items()))}')
+
+    if args.nightly:
+        day = health_bot.datetime.fromtimestamp(trace[-1]['date'], health_bot.timezone('Europe/Moscow')).date()
+        started = time.monotonic()
+        health_bot.penalize_missed_day(day)
+        print(f'missed-day job for {day}: {(time.monotonic() - started) * 1000:.1f} ms')
+        started = time.monotonic()
+        health_bot.refresh_chat_stats()
+        print(f'chat_stats refresh: {(time.monotonic() - started) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        required=not os.getenv('BENCH_DATABASE_URL'),
+                        help='отдельная база для бенчмарка, её данные будут стёрты')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--chats', type=int, default=5)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=1, help='потоков обработки, апдейты шардируются по user_id')
+    parser.add_argument('--api-latency', type=float, default=0, help='задержка ответа заглушки Telegram, мс')
+    parser.add_argument('--runtime', choices=('direct', 'polling', 'asyncio'), default='direct',
+                        help='direct - прямо в обработчики с разбивкой по командам, polling/asyncio - через рантайм')
+    parser.add_argument('--trace', help='прогнать трассу из файла JSON lines вместо синтетической')
+    parser.add_argument('--save-trace', help='сохранить трассу в файл')
+    parser.add_argument('--keep-data', action='store_true', help='не очищать данные бота перед прогоном')
+    parser.add_argument('--nightly', action='store_true', help='после трассы замерить ночную задачу пропусков и пересчёт chat_stats')
+    run(parser.parse_args())
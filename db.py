@@ -0,0 +1,564 @@
+"""Доступ к базе health_bot: пул соединений, схема и именованные запросы.
+
+Все запросы бота лежат в STATEMENTS и выполняются по имени с параметрами $1, $2, ...
+На каждом соединении пула запрос при первом использовании готовится через PREPARE, дальше выполняется
+через EXECUTE без повторного разбора и планирования. Время выполнения каждого запроса попадает
+в гистограмму DbEngine.histograms (метрика db_query_seconds).
+"""
+import atexit
+import io
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+from metrics import DB_QUERY_ERRORS, DB_QUERY_SECONDS
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+DATABASE_SSLMODE = os.getenv('DATABASE_SSLMODE', 'require')
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '4'))
+DB_PREPARE = os.getenv('DB_PREPARE', '1') == '1'  # 0 - без PREPARE, например за pgbouncer в режиме transaction
+
+root_logger = logging.getLogger()
+
+# московский день записи activity; должен совпадать с выражением индекса activity_user_day
+ACTIVITY_DAY = "(ts AT TIME ZONE 'Europe/Moscow')::date"
+
+# счётчики user_counters в порядке achieve_id; t - московское время тренировки
+ACHIEVE_COUNTERS = [('morning', "t > '04:00' AND t <= '11:00'"),
+                    ('day', "t > '11:00' AND t <= '15:00'"),
+                    ('evening', "t > '15:00' AND t <= '23:00'"),
+                    ('night', "t > '23:00' OR t <= '04:00'"),
+                    ('photo', 'proof_id = 0'),
+                    ('video', 'proof_id = 1')]
+COUNTER_NAMES = ', '.join(name for name, _ in ACHIEVE_COUNTERS)
+
+STATEMENTS = {
+    'reference_data': '''SELECT 'levels', level, name FROM levels 
+                         UNION ALL SELECT 'achieves', achieve_id, name FROM achieves 
+                         UNION ALL SELECT 'proof_types', proof_id, name FROM proof_types 
+                         UNION ALL SELECT 'action_types', action_id, name FROM action_types''',
+    'media_cache_all': '''SELECT content_hash, file_id FROM media_cache''',
+    'media_cache_put': '''INSERT INTO media_cache VALUES ($1, $2) 
+                          ON CONFLICT (content_hash) DO UPDATE SET 
+                          file_id = EXCLUDED.file_id''',
+
+    'awaiting_user_states': '''SELECT user_id, task_type FROM user_states WHERE state=1''',
+    'set_user_state': '''WITH prev AS (SELECT state FROM user_states WHERE user_id=$1) 
+                         INSERT INTO user_states VALUES ($1, $2, $3) 
+                         ON CONFLICT (user_id) DO UPDATE SET 
+                         state = EXCLUDED.state,
+                         task_type = EXCLUDED.task_type 
+                         RETURNING (SELECT state FROM prev)''',
+    # снимает ожидание загрузки и возвращает task_type; из двух одновременных вызовов строку получит один
+    'take_user_state': '''UPDATE user_states u SET state = 0, task_type = NULL 
+                          FROM (SELECT user_id, task_type FROM user_states 
+                                WHERE user_id=$1 AND state=1 FOR UPDATE) old 
+                          WHERE u.user_id = old.user_id 
+                          RETURNING old.task_type''',
+
+    'activity_on_day': f'''SELECT 1 FROM activity WHERE user_id=$1 AND {ACTIVITY_DAY}=$2''',
+    # запись тренировки и счётчики достижений обновляются одним атомарным запросом
+    'record_task': f'''WITH task AS (INSERT INTO activity (user_id, action_id, proof_id, chat_id, ts) 
+                                     VALUES ($1, $2, $3, $4, $5) 
+                                     RETURNING user_id, chat_id, proof_id, (ts AT TIME ZONE 'Europe/Moscow')::time AS t) 
+                      INSERT INTO user_counters AS c (user_id, chat_id, tasks, {COUNTER_NAMES}) 
+                      SELECT user_id, chat_id, 1, {', '.join(f'({cond})::int' for _, cond in ACHIEVE_COUNTERS)} 
+                      FROM task 
+                      ON CONFLICT (user_id, chat_id) DO UPDATE SET 
+                      tasks = c.tasks + EXCLUDED.tasks, 
+                      {', '.join(f'{name} = c.{name} + EXCLUDED.{name}' for name, _ in ACHIEVE_COUNTERS)} 
+                      RETURNING tasks, {COUNTER_NAMES}''',
+    'gift_candidates': '''SELECT DISTINCT user_id FROM activity WHERE user_id!=$1 AND chat_id=$2''',
+
+    # /stat одним запросом: агрегаты по тренировкам в чате, уровень, карма и достижения
+    'user_stat': '''SELECT s.task_count, 
+                           (s.last_ts AT TIME ZONE 'Europe/Moscow')::date - 
+                           (s.first_ts AT TIME ZONE 'Europe/Moscow')::date, 
+                           ul.level, COALESCE(r.rating, 100), 
+                           ARRAY(SELECT achieve_id FROM user_achieves WHERE user_id=$1 ORDER BY achieve_id) 
+                    FROM (SELECT COUNT(*) AS task_count, MIN(ts) AS first_ts, MAX(ts) AS last_ts 
+                          FROM activity WHERE user_id=$1 AND chat_id=$2 AND action_id=0) s 
+                    LEFT JOIN user_levels ul ON ul.user_id=$1 
+                    LEFT JOIN ratings r ON r.user_id=$1''',
+
+    'upsert_user_level': '''WITH prev AS (SELECT level FROM user_levels WHERE user_id=$1) 
+                            INSERT INTO user_levels VALUES ($1, $2, $3, $4) 
+                            ON CONFLICT (user_id) DO UPDATE SET 
+                            level = EXCLUDED.level, 
+                            firstname = EXCLUDED.firstname, 
+                            username = EXCLUDED.username 
+                            RETURNING (SELECT level FROM prev)''',
+    # вставятся и вернутся только новые достижения
+    'grant_achieves': '''INSERT INTO user_achieves SELECT $1, unnest($2::integer[]) 
+                         ON CONFLICT DO NOTHING RETURNING achieve_id''',
+
+    # чтение, ограничение 0..100 и запись одним запросом, параллельные изменения не теряются
+    'change_rating': '''INSERT INTO ratings VALUES ($1, LEAST(GREATEST(100 + $2::real, 0), 100)) 
+                        ON CONFLICT (user_id) DO UPDATE SET 
+                        rating = LEAST(GREATEST(ratings.rating + $2::real, 0), 100) 
+                        RETURNING rating''',
+    'change_ratings': '''WITH d AS (SELECT * FROM unnest($1::bigint[], $2::real[]) AS d(user_id, delta)) 
+                         INSERT INTO ratings SELECT user_id, LEAST(GREATEST(100 + delta, 0), 100) FROM d 
+                         ON CONFLICT (user_id) DO UPDATE SET 
+                         rating = LEAST(GREATEST(ratings.rating + 
+                                                 (SELECT delta FROM d WHERE d.user_id=EXCLUDED.user_id), 0), 100)''',
+
+    # кого можно поблагодарить в чате: все, кто сдавал в нём тренировки
+    'chat_love_members': '''SELECT l.user_id, l.firstname, l.username FROM user_counters c 
+                            JOIN user_levels l ON l.user_id = c.user_id 
+                            WHERE c.chat_id=$1 
+                            ORDER BY l.firstname, l.user_id''',
+
+    # пропуски за московский день $1: пары пользователь/чат, где пользователь тренировался в последние $4 дней
+    # до этого дня, а за сам день тренировки нет ни в одном чате - activity_user_day допускает одну запись
+    # в день на пользователя. Кто не тренировался в чате дольше $4 дней (в том числе ушёл из чата), больше
+    # не штрафуется. Записи в penalties - по чату (для уведомлений), а рейтинг общий, и штраф $2 снимается один
+    # раз за день, даже если пропуск в нескольких чатах: penalties в подзапросе видна ещё без новых строк, так что
+    # и повторный запуск, и пропуск, добавившийся в другом чате, второй раз не штрафуют
+    'penalize_missed_day': '''WITH day AS (SELECT $1::date::timestamp AT TIME ZONE 'Europe/Moscow' AS start_ts, 
+                                                 ($1::date + 1)::timestamp AT TIME ZONE 'Europe/Moscow' AS end_ts, 
+                                                 ($1::date - $4::integer)::timestamp AT TIME ZONE 'Europe/Moscow' 
+                                                 AS active_ts), 
+                                   missed AS (SELECT c.user_id, c.chat_id FROM user_counters c, day 
+                                              WHERE EXISTS (SELECT 1 FROM activity a 
+                                                            WHERE a.user_id=c.user_id AND a.chat_id=c.chat_id 
+                                                            AND a.action_id=$3 
+                                                            AND a.ts >= day.active_ts AND a.ts < day.start_ts) 
+                                              AND NOT EXISTS (SELECT 1 FROM activity a 
+                                                              WHERE a.user_id=c.user_id AND a.action_id=$3 
+                                                              AND a.ts >= day.start_ts AND a.ts < day.end_ts)), 
+                                   penalized AS (INSERT INTO penalties (user_id, chat_id, day) 
+                                                 SELECT user_id, chat_id, $1 FROM missed 
+                                                 ON CONFLICT DO NOTHING 
+                                                 RETURNING user_id), 
+                                   rated AS (INSERT INTO ratings 
+                                             SELECT DISTINCT p.user_id, LEAST(GREATEST(100 + $2::real, 0), 100) 
+                                             FROM penalized p 
+                                             WHERE NOT EXISTS (SELECT 1 FROM penalties q 
+                                                               WHERE q.user_id=p.user_id AND q.day=$1) 
+                                             ON CONFLICT (user_id) DO UPDATE SET 
+                                             rating = LEAST(GREATEST(ratings.rating + $2::real, 0), 100)) 
+                              SELECT COUNT(*) FROM penalized''',
+    # неотправленные уведомления о пропусках со случайным получателем подарка из того же чата
+    'unnotified_penalties': '''SELECT p.user_id, p.chat_id, p.day, g.user_id FROM penalties p 
+                               LEFT JOIN LATERAL (SELECT c.user_id FROM user_counters c 
+                                                  WHERE c.chat_id=p.chat_id AND c.user_id!=p.user_id 
+                                                  ORDER BY random() LIMIT 1) g ON true 
+                               WHERE NOT p.notified 
+                               ORDER BY p.day, p.chat_id''',
+    'mark_penalty_notified': '''UPDATE penalties SET notified = true WHERE user_id=$1 AND chat_id=$2 AND day=$3''',
+
+    # чаты, где с прошлого пересчёта chat_stats появились тренировки; минута запаса покрывает
+    # транзакции, которые начались до прошлого пересчёта, а закоммитились после него
+    'chat_stats_dirty': '''SELECT now(), ARRAY(SELECT DISTINCT chat_id FROM activity 
+                                               WHERE created_at > (SELECT COALESCE(MAX(refreshed_at), '-infinity') 
+                                                                   FROM chat_stats) - interval '1 minute' 
+                                               AND action_id=$1 AND chat_id IS NOT NULL)''',
+    'upsert_chat_stats': '''INSERT INTO chat_stats (chat_id, user_id, trainings, current_streak, longest_streak, 
+                                                    last_day, refreshed_at) 
+                            SELECT chat_id, user_id, trainings, current_streak, longest_streak, 
+                                   DATE '1970-01-01' + last_day, $7 
+                            FROM unnest($1::bigint[], $2::bigint[], $3::integer[], $4::integer[], $5::integer[], 
+                                        $6::integer[]) 
+                                 AS s(chat_id, user_id, trainings, current_streak, longest_streak, last_day) 
+                            ON CONFLICT (chat_id, user_id) DO UPDATE SET 
+                            trainings = EXCLUDED.trainings, 
+                            current_streak = EXCLUDED.current_streak, 
+                            longest_streak = EXCLUDED.longest_streak, 
+                            last_day = EXCLUDED.last_day, 
+                            refreshed_at = EXCLUDED.refreshed_at''',
+    # карма меняется без новых тренировок, поэтому места по карме пересчитываются во всех чатах;
+    # переписываются только изменившиеся строки
+    'rank_chat_karma': '''UPDATE chat_stats s SET karma = k.rating, karma_rank = k.place 
+                          FROM (SELECT s.chat_id, s.user_id, COALESCE(r.rating, 100) AS rating, 
+                                       RANK() OVER (PARTITION BY s.chat_id 
+                                                    ORDER BY COALESCE(r.rating, 100) DESC)::integer AS place 
+                                FROM chat_stats s LEFT JOIN ratings r ON r.user_id = s.user_id) k 
+                          WHERE s.chat_id = k.chat_id AND s.user_id = k.user_id 
+                          AND (s.karma IS DISTINCT FROM k.rating OR s.karma_rank IS DISTINCT FROM k.place)''',
+    # /top и недельная сводка: серия жива, если последняя тренировка была в день $2 или накануне
+    # (вчерашний день ещё можно закрыть через /debt)
+    'chat_top': '''SELECT s.user_id, l.firstname, l.username, s.trainings, 
+                          CASE WHEN s.last_day >= $2::date - 1 THEN s.current_streak ELSE 0 END, 
+                          s.longest_streak, s.karma_rank 
+                   FROM chat_stats s LEFT JOIN user_levels l ON l.user_id = s.user_id 
+                   WHERE s.chat_id=$1 
+                   ORDER BY s.trainings DESC, s.longest_streak DESC, s.user_id 
+                   LIMIT $3''',
+    'digest_chats': '''SELECT DISTINCT chat_id FROM chat_stats WHERE last_day > $1::date - 7''',
+
+    'last_job_run': '''SELECT MAX(day) FROM job_runs WHERE job=$1''',
+    'record_job_run': '''INSERT INTO job_runs VALUES ($1, $2) ON CONFLICT DO NOTHING''',
+    'job_runs_on_day': '''SELECT job FROM job_runs WHERE day=$1 AND starts_with(job, $2)''',
+}
+
+_PYFORMAT_PARAMS = re.compile(r'\$(\d+)')
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()  # имена запросов, подготовленных на этом соединении
+        self.reused = False  # соединение уже полежало в пуле и могло умереть, пока ждало
+
+
+class DbEngine:
+    """Пул соединений с Postgres.
+
+    Поток берёт соединение при первом обращении к cursor() и возвращает его в пул, когда выходит из
+    самого внешнего блока with; вложенные вызовы в том же потоке переиспользуют уже взятое соединение.
+    Живость соединения не проверяется заранее: сломанное соединение выбрасывается из пула только
+    после того, как на нём случилась OperationalError, а замена создаётся при следующем запросе.
+    Если так умерло соединение из пула (например, Postgres перезапустился), execute выбрасывает
+    остальные простаивающие соединения и один раз повторяет запрос на новом.
+    """
+
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+        # счётчики ожидания соединения
+        self.checkouts = 0
+        self.checkout_waits = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+        self.reconnects = 0
+        self.retries = 0
+        self.histograms = {name: DB_QUERY_SECONDS.labels(name) for name in STATEMENTS}
+
+        for _ in range(self.min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+        atexit.register(self.cleanup)
+
+    @staticmethod
+    def _connect():
+        db_conn = psycopg2.connect(DATABASE_URL, sslmode=DATABASE_SSLMODE, connection_factory=PooledConnection)
+        db_conn.autocommit = True
+        return db_conn
+
+    def checkout(self):
+        start = time.monotonic()
+        db_conn = None
+        with self._cond:
+            while not self._idle and self._size >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                db_conn = self._idle.pop()
+            else:
+                self._size += 1  # резервируем место, само соединение откроем вне блокировки
+
+        if db_conn is None:
+            try:
+                db_conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+
+        wait = time.monotonic() - start
+        with self._cond:
+            self.checkouts += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+            if wait > 0.001:
+                self.checkout_waits += 1
+        return db_conn
+
+    def checkin(self, db_conn, broken=False):
+        with self._cond:
+            if broken or db_conn.closed:
+                self._size -= 1
+                self.reconnects += 1
+                try:
+                    db_conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                db_conn.reused = True
+                self._idle.append(db_conn)
+            self._cond.notify()
+
+    def discard_idle(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self.reconnects += len(idle)
+            self._cond.notify_all()
+        for db_conn in idle:
+            try:
+                db_conn.close()
+            except psycopg2.Error:
+                pass
+
+    @contextmanager
+    def cursor(self):
+        local = self._local
+        if getattr(local, 'db_conn', None) is not None:  # соединение уже взято этим потоком
+            try:
+                yield local.db_conn.cursor()
+            except psycopg2.OperationalError:
+                local.broken = True
+                raise
+            return
+
+        local.stale = False
+        local.db_conn = self.checkout()
+        local.broken = False
+        try:
+            yield local.db_conn.cursor()
+        except psycopg2.OperationalError:
+            local.broken = True
+            raise
+        finally:
+            db_conn, broken = local.db_conn, local.broken
+            local.db_conn = None
+            # соединение из пула потеряно, а не, скажем, отменён запрос по statement_timeout
+            local.stale = broken and db_conn.reused and bool(db_conn.closed)
+            self.checkin(db_conn, broken)
+
+    def execute(self, name, *params):
+        """Выполняет именованный запрос и возвращает все строки результата (или None, если их нет)."""
+        if getattr(self._local, 'db_conn', None) is not None:
+            return self._execute(name, params)  # внутри чужого блока cursor() повторять нельзя
+
+        try:
+            return self._execute(name, params)
+        except psycopg2.OperationalError as e:
+            if not getattr(self._local, 'stale', False):  # checkout мог упасть ещё до cursor()
+                raise
+            root_logger.warning(f'{name}: pooled connection lost ({e}), retrying on a new connection')
+            self.discard_idle()  # после перезапуска Postgres они мертвы все
+            self.retries += 1
+            return self._execute(name, params)
+
+    def _execute(self, name, params):
+        with self.cursor() as cur:
+            start = time.monotonic()
+            try:
+                if DB_PREPARE:
+                    self._execute_prepared(cur, name, params)
+                else:
+                    cur.execute(_PYFORMAT_PARAMS.sub(r'%(p\1)s', STATEMENTS[name]),
+                                {f'p{i + 1}': value for i, value in enumerate(params)})
+                return cur.fetchall() if cur.description is not None else None
+            except psycopg2.Error:
+                DB_QUERY_ERRORS.labels(name).inc()
+                raise
+            finally:
+                self.histograms[name].observe(time.monotonic() - start)
+
+    def fetchone(self, name, *params):
+        rows = self.execute(name, *params)
+        return rows[0] if rows else None
+
+    def fetchall(self, name, *params):
+        return self.execute(name, *params) or []
+
+    @staticmethod
+    def _execute_prepared(cur, name, params):
+        db_conn = cur.connection
+        if name not in db_conn.prepared:
+            cur.execute(f'PREPARE {name} AS {STATEMENTS[name]}')
+            db_conn.prepared.add(name)
+        if params:
+            cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+        else:
+            cur.execute(f'EXECUTE {name}')
+
+    def statement_stats(self):
+        return {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+
+    def stats(self):
+        with self._cond:
+            return {'size': self._size,
+                    'idle': len(self._idle),
+                    'max_size': self.max_size,
+                    'checkouts': self.checkouts,
+                    'checkout_waits': self.checkout_waits,
+                    'checkout_wait_total': self.checkout_wait_total,
+                    'checkout_wait_max': self.checkout_wait_max,
+                    'reconnects': self.reconnects,
+                    'retries': self.retries}
+
+    def cleanup(self):
+        with self._cond:
+            for db_conn in self._idle:
+                db_conn.close()
+            self._idle = []
+
+
+# справочники; вставляются одним запросом на таблицу, существующие строки не трогаются
+SEED_DATA = {
+    'action_types': [(0, 'task'), (1, 'pass'), (2, 'force major')],
+    'proof_types': [(0, 'photo'), (1, 'video')],
+    'achieves': [(0, 'Ранняя пташка'), (1, 'Дневная бабочка'), (2, 'Поздняя пташка'), (3, 'Ночная бабочка'),
+                 (4, 'Фотоохотник'), (5, 'Сам себе режиссёр')],
+    'levels': [(0, 'Киберспортмен'), (1, 'Зелёный'), (2, 'Подтянутый'), (3, 'Фитоняш'), (4, 'Стальный мышцы'),
+               (5, 'Мощный'), (6, 'Опытный боец'), (7, 'Победитель по жизни'), (8, 'Мастер'), (9, 'Гуру'),
+               (10, 'Тибетский монах'), (11, 'Легендарный'), (12, 'Бесконечность не предел'),
+               (13, 'Спортивный маньяк')],
+}
+
+SCHEMA_LOCK_ID = 7210001  # ключ pg_advisory_xact_lock, чтобы два процесса не мигрировали одновременно
+
+
+def _migration_1(cur):
+    # схема, которую раньше create_schema создавала на каждом старте; все команды идемпотентны, так что
+    # на уже работающей базе миграция только досоздаст недостающее
+    cur.execute(f'''CREATE TABLE IF NOT EXISTS user_levels
+                (user_id bigint PRIMARY KEY, level integer, firstname text, username text);
+                CREATE TABLE IF NOT EXISTS user_states
+                (user_id bigint PRIMARY KEY, state integer, task_type text);
+                CREATE TABLE IF NOT EXISTS achieves
+                (achieve_id integer PRIMARY KEY, name text);
+                CREATE TABLE IF NOT EXISTS levels
+                (level integer PRIMARY KEY, name text);
+                CREATE TABLE IF NOT EXISTS ratings
+                (user_id bigint PRIMARY KEY, rating REAL);
+                CREATE TABLE IF NOT EXISTS action_types
+                (action_id integer PRIMARY KEY, name text);
+                CREATE TABLE IF NOT EXISTS proof_types
+                (proof_id integer PRIMARY KEY, name text);
+
+                CREATE TABLE IF NOT EXISTS activity
+                (user_id bigint NOT NULL, date text, time text, action_id integer REFERENCES action_types(action_id), 
+                proof_id integer REFERENCES proof_types(proof_id), chat_id bigint, ts timestamptz,
+                UNIQUE(user_id,date) );
+                -- date и time раньше хранились текстом в формате %m/%d/%Y, переносим их в ts
+                ALTER TABLE activity ADD COLUMN IF NOT EXISTS ts timestamptz;
+                UPDATE activity SET ts = to_timestamp(date || ' ' || COALESCE(time, '00:00:00'), 
+                                                      'MM/DD/YYYY HH24:MI:SS')::timestamp AT TIME ZONE 'Europe/Moscow' 
+                WHERE ts IS NULL AND date IS NOT NULL;
+                CREATE UNIQUE INDEX IF NOT EXISTS activity_user_day ON activity (user_id, ({ACTIVITY_DAY}));
+                CREATE INDEX IF NOT EXISTS activity_user_chat_action_ts ON activity (user_id, chat_id, action_id, ts);
+                CREATE INDEX IF NOT EXISTS activity_chat_user ON activity (chat_id, user_id);
+                CREATE TABLE IF NOT EXISTS user_achieves
+                (user_id bigint NOT NULL, achieve_id integer REFERENCES achieves(achieve_id),
+                UNIQUE(user_id, achieve_id));
+                CREATE TABLE IF NOT EXISTS media_cache
+                (content_hash text PRIMARY KEY, file_id text NOT NULL);
+                CREATE TABLE IF NOT EXISTS user_counters
+                (user_id bigint NOT NULL, chat_id bigint NOT NULL, tasks integer NOT NULL DEFAULT 0, 
+                {', '.join(f'{name} integer NOT NULL DEFAULT 0' for name, _ in ACHIEVE_COUNTERS)},
+                PRIMARY KEY(user_id, chat_id));
+                CREATE INDEX IF NOT EXISTS user_counters_chat ON user_counters (chat_id);
+                CREATE TABLE IF NOT EXISTS penalties
+                (user_id bigint NOT NULL, chat_id bigint NOT NULL, day date NOT NULL, 
+                notified boolean NOT NULL DEFAULT false, PRIMARY KEY(user_id, chat_id, day));
+                CREATE INDEX IF NOT EXISTS penalties_unnotified ON penalties (day) WHERE NOT notified;
+                CREATE TABLE IF NOT EXISTS job_runs
+                (job text NOT NULL, day date NOT NULL, PRIMARY KEY(job, day));''')
+
+    for table, rows in SEED_DATA.items():
+        cur.execute(f'INSERT INTO {table} VALUES {", ".join(["%s"] * len(rows))} ON CONFLICT DO NOTHING', rows)
+
+    cur.execute('''SELECT EXISTS(SELECT 1 FROM user_counters)''')
+    if not cur.fetchone()[0]:
+        _backfill_counters(cur)
+        root_logger.info('user_counters backfilled')
+
+
+def _migration_2(cur):
+    # сводка по участникам чата для /top; created_at в activity отмечает, какие чаты пересчитать
+    cur.execute('''ALTER TABLE activity ADD COLUMN IF NOT EXISTS created_at timestamptz NOT NULL DEFAULT now();
+                CREATE INDEX IF NOT EXISTS activity_created ON activity USING brin (created_at);
+                CREATE TABLE IF NOT EXISTS chat_stats
+                (chat_id bigint NOT NULL, user_id bigint NOT NULL, trainings integer NOT NULL, 
+                current_streak integer NOT NULL, longest_streak integer NOT NULL, last_day date NOT NULL, 
+                karma real, karma_rank integer, refreshed_at timestamptz NOT NULL, 
+                PRIMARY KEY(chat_id, user_id));
+                CREATE INDEX IF NOT EXISTS chat_stats_top 
+                ON chat_stats (chat_id, trainings DESC, longest_streak DESC, user_id);''')
+
+
+# миграции применяются по порядку, номер версии - позиция в списке; новые добавляются только в конец
+MIGRATIONS = [_migration_1, _migration_2]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def create_schema(cur):
+    """Доводит схему до SCHEMA_VERSION. Если база уже на этой версии, это один запрос."""
+    try:
+        cur.execute('''SELECT MAX(version) FROM schema_migrations''')
+        if (cur.fetchone()[0] or 0) >= SCHEMA_VERSION:
+            return False
+    except psycopg2.errors.UndefinedTable:
+        pass
+
+    try:
+        cur.execute('BEGIN')
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_ID,))
+        cur.execute('''CREATE TABLE IF NOT EXISTS schema_migrations
+                    (version integer PRIMARY KEY, applied_at timestamptz NOT NULL DEFAULT now());''')
+        cur.execute('''SELECT COALESCE(MAX(version), 0) FROM schema_migrations''')
+        version = cur.fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(cur)
+            cur.execute('''INSERT INTO schema_migrations (version) VALUES (%s)''', (number,))
+            root_logger.info(f'schema migration {number} applied')
+        cur.execute('COMMIT')
+    except psycopg2.Error:
+        cur.execute('ROLLBACK')  # соединение в autocommit, не оставляем его в прерванной транзакции
+        raise
+    return version < SCHEMA_VERSION  # False, если схему успел обновить другой процесс
+
+
+def backfill_counters(cur):
+    # пересчитываем user_counters по всей истории activity; таблица блокируется, чтобы параллельные
+    # загрузки дождались конца пересчёта и прибавили свою тренировку уже к новым значениям
+    try:
+        cur.execute('BEGIN')
+        _backfill_counters(cur)
+        cur.execute('COMMIT')
+    except psycopg2.Error:
+        cur.execute('ROLLBACK')  # соединение в autocommit, не оставляем его в прерванной транзакции
+        raise
+    root_logger.info('user_counters backfilled')
+
+
+def _backfill_counters(cur):
+    cur.execute(f'''LOCK TABLE user_counters IN SHARE ROW EXCLUSIVE MODE;
+                INSERT INTO user_counters (user_id, chat_id, tasks, {COUNTER_NAMES})
+                SELECT user_id, chat_id, COUNT(*), 
+                       {', '.join(f'COUNT(*) FILTER (WHERE {cond})' for _, cond in ACHIEVE_COUNTERS)}
+                FROM (SELECT user_id, chat_id, proof_id, (ts AT TIME ZONE 'Europe/Moscow')::time AS t 
+                      FROM activity WHERE action_id=0 AND chat_id IS NOT NULL AND ts IS NOT NULL) tasks
+                GROUP BY user_id, chat_id
+                ON CONFLICT (user_id, chat_id) DO UPDATE SET 
+                tasks = EXCLUDED.tasks, 
+                {', '.join(f'{name} = EXCLUDED.{name}' for name, _ in ACHIEVE_COUNTERS)};''')
+
+
+# строка COPY BINARY из export_tasks: число полей, затем длина и значение каждого поля, всё big-endian
+_TASK_ROW = np.dtype([('fields', '>i2'), ('chat_id_len', '>i4'), ('chat_id', '>i8'), ('user_id_len', '>i4'),
+                      ('user_id', '>i8'), ('day_len', '>i4'), ('day', '>i4')])
+_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+
+def export_tasks(cur, chat_ids, action_id):
+    """Тренировки чатов одним COPY BINARY: массивы chat_id, user_id и московского дня (дни с 1970-01-01)."""
+    buffer = io.BytesIO()
+    cur.copy_expert(cur.mogrify(f'''COPY (SELECT chat_id, user_id, {ACTIVITY_DAY} - DATE '1970-01-01' FROM activity 
+                                        WHERE chat_id = ANY(%s) AND action_id = %s AND ts IS NOT NULL) 
+                                  TO STDOUT WITH (FORMAT binary)''', (chat_ids, action_id)).decode(), buffer)
+    data = buffer.getbuffer()
+    # заголовок: сигнатура, флаги и длина расширения (её Postgres не заполняет), в конце - признак конца -1
+    if data[:11] != _COPY_SIGNATURE or int.from_bytes(data[15:19], 'big') != 0:
+        raise ValueError('unexpected COPY BINARY header')
+    rows = np.frombuffer(data, dtype=_TASK_ROW, offset=19, count=(len(data) - 21) // _TASK_ROW.itemsize)
+    return rows['chat_id'].astype(np.int64), rows['user_id'].astype(np.int64), rows['day'].astype(np.int64)
@@ -2,7 +2,9 @@ import datetime
 import telebot
 from telebot import types
 import os
+import sys
 import random
+import re
 import logging
 import numpy as np
 from datetime import datetime, timedelta
@@ -10,43 +12,560 @@ from pytz import timezone
 from random import randint
 import psycopg2
 import atexit
+import hashlib
+import multiprocessing
+import signal
+import threading
+import time
+import heapq
+import queue
+import json
+import asyncio
+import aiohttp
+from aiohttp import web
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import groupby
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from db import DbEngine, create_schema, backfill_counters, export_tasks
+from metrics import REGISTRY, instrument, start_metrics_server
+
+BOT_RUNTIME = os.getenv('BOT_RUNTIME', 'polling')  # polling | asyncio | webhook | supervisor
+SUPERVISOR_INTAKE = os.getenv('SUPERVISOR_INTAKE', 'webhook')  # как supervisor получает апдейты: asyncio | webhook
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', str(os.cpu_count() or 1)))
+USER_STATE_SLOTS = 65536
+ASYNC_WORKERS = int(os.getenv('ASYNC_WORKERS', '32'))  # обработчики в основном ждут Telegram, а не базу
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # внешний адрес, например https://<app>.herokuapp.com
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+RATING_FLUSH_INTERVAL = float(os.getenv('RATING_FLUSH_INTERVAL', '0'))  # 0 - писать карму сразу
+CHAT_MEMBER_CACHE_SIZE = int(os.getenv('CHAT_MEMBER_CACHE_SIZE', '10000'))
+CHAT_MEMBER_CACHE_TTL = int(os.getenv('CHAT_MEMBER_CACHE_TTL', '3600'))
+LOVE_PAGE_SIZE = 8
+LOVE_CACHE_SIZE = int(os.getenv('LOVE_CACHE_SIZE', '1000'))
+LOVE_CACHE_TTL = int(os.getenv('LOVE_CACHE_TTL', '600'))
+ASSET_MANIFEST = os.getenv('ASSET_MANIFEST', 'assets.json')  # собирается командой build-assets
+USER_STATE_TTL = int(os.getenv('USER_STATE_TTL', '86400'))  # через сколько секунд перепроверять ожидание в базе
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '25'))  # сообщений в секунду на весь бот
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '20'))  # сообщений в минуту в один чат
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', '3'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_MAX_RETRIES = 5
+OUTBOX_ACTION_BACKLOG = 100  # статусов «печатает…» в ожидании отправки, сверх этого они не отправляются
+OUTBOX_DRAIN_TIMEOUT = 20  # Heroku даёт 30 секунд между SIGTERM и SIGKILL
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', '1') == '1'
+SCHEDULER_RUN_AT = os.getenv('SCHEDULER_RUN_AT', '00:05')  # московское время ежедневных задач
+MISSED_DAY_PENALTY = -5
+MISSED_DAY_ACTIVE_DAYS = int(os.getenv('MISSED_DAY_ACTIVE_DAYS', '7'))  # дольше без тренировок в чате - не штрафуем
+MISSED_DAY_NOTICE_LINES = 20  # строк в одном уведомлении, чтобы не упереться в 4096 символов
+STATS_REFRESH_INTERVAL = int(os.getenv('STATS_REFRESH_INTERVAL', '300'))  # секунды, 0 - только перед сводкой
+TOP_SIZE = 10
+DIGEST_SIZE = 50  # строк в недельной сводке, чтобы сообщение влезло в 4096 символов
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 - метрики только на /<токен>/metrics вебхука
+LOG_FILE = os.getenv('LOG_FILE', 'health.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # text | json
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
 
-DATABASE_URL = os.getenv('DATABASE_URL')
 
 root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler('health.log', 'w', 'utf-8')
-handler.setFormatter(logging.Formatter('%(name)s %(message)s'))
-root_logger.addHandler(handler)
+root_logger.setLevel(LOG_LEVEL)
+# в файл пишет отдельный поток, обработчики только кладут запись в очередь
+log_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+log_handler.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else
+                         logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+log_queue = queue.SimpleQueue()
+root_logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 token = os.getenv("HEALTH_TOKEN")
+if os.getenv('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL')  # например, локальный фейковый API для замеров
 bot = telebot.TeleBot(token)
+WEBHOOK_PATH = f'/{token}'
 random.seed(datetime.now().timestamp())
 
+ACHIEVE_STEP = 20
+LEVEL_STEP = 30  # month
 
-class DbEngine:
-    def __init__(self):
-        self.db_conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        self.db_conn.autocommit = True
-        atexit.register(self.cleanup)
+db_engine = DbEngine()
 
-    def reconnect(self):
-        try:
-            cur = self.db_conn.cursor()
-            cur.execute('SELECT 1')
-        except psycopg2.OperationalError:
-            self.db_conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-            self.db_conn.autocommit = True
 
-    def get_cursor(self):
-        self.reconnect()  # проверим живо ли соединение
-        return self.db_conn.cursor()
+class MediaCache:
+    """file_id уже загруженных в Telegram гифок и стикеров.
 
-    def cleanup(self):
-        self.db_conn.close()
+    Ключ - sha256 содержимого файла, так что переименование файла не требует повторной загрузки.
+    Файл загружается с диска только в первый раз, дальше отправляется по file_id.
+    """
 
+    def __init__(self):
+        self._file_ids = {}
+        self._hashes = {}  # path -> (mtime, size, sha256)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.uploads = 0
+
+    def load(self):
+        with self._lock:
+            self._file_ids.update(db_engine.fetchall('media_cache_all'))
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as media_file:
+            for chunk in iter(lambda: media_file.read(1 << 20), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        self._hashes[path] = (stat.st_mtime, stat.st_size, content_hash)
+        return content_hash
+
+    def send(self, send_function, chat_id, path, reply_to_message_id=None):
+        content_hash = self.content_hash(path)
+        file_id = self._file_ids.get(content_hash)
+        if file_id is not None:
+            try:
+                sent = send_function(chat_id, file_id, reply_to_message_id=reply_to_message_id)
+                self.hits += 1
+                return sent
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                root_logger.error(f'file_id for {path} is rejected, uploading again')  # например, сменился токен
+
+        with open(path, 'rb') as media_file:
+            sent = send_function(chat_id, media_file, reply_to_message_id=reply_to_message_id)
+        self.uploads += 1
+
+        media = sent.animation or sent.sticker or sent.document or sent.video
+        if media is not None:
+            with self._lock:
+                self._file_ids[content_hash] = media.file_id
+            db_engine.execute('media_cache_put', content_hash, media.file_id)
+        return sent
+
+    def prewarm(self, chat_id):
+        for folder, send_function in (('training', bot.send_animation), ('stickers', bot.send_sticker)):
+            for path in assets.paths(folder):
+                if self.content_hash(path) in self._file_ids:
+                    continue
+                self.send(send_function, chat_id, path)
+                time.sleep(1)  # не упираемся в ограничение Telegram на частоту сообщений в чат
+        root_logger.info(f'Media cache prewarmed: {len(self._file_ids)} files')
+
+
+media_cache = MediaCache()
+
+
+class AssetManifest:
+    """Списки файлов training/ и stickers/, чтобы не читать каталоги на каждый запрос.
+
+    Берутся из ASSET_MANIFEST, если он собран заранее, иначе каталоги сканируются один раз при первом обращении.
+    После замены файлов манифест нужно пересобрать: python health_bot.py build-assets
+    """
+    FOLDERS = ('training', 'stickers')
+
+    def __init__(self, path):
+        self.path = path
+        self._paths = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._paths is not None:
+                return self._paths
+            try:
+                with open(self.path, encoding='utf-8') as manifest_file:
+                    self._paths = json.load(manifest_file)
+                root_logger.info(f'Asset manifest loaded from {self.path}')
+            except FileNotFoundError:
+                self._paths = self.scan()
+            return self._paths
+
+    def scan(self):
+        return {folder: [folder + '/' + filename for filename in sorted(os.listdir(folder))]
+                for folder in self.FOLDERS}
+
+    def build(self):
+        paths = self.scan()
+        with open(self.path, 'w', encoding='utf-8') as manifest_file:
+            json.dump(paths, manifest_file, ensure_ascii=False, indent=1)
+        with self._lock:
+            self._paths = paths
+        root_logger.info(f'Asset manifest written to {self.path}: '
+                         f'{", ".join(f"{folder} {len(items)}" for folder, items in paths.items())}')
+
+    def paths(self, folder):
+        paths = self._paths if self._paths is not None else self.load()
+        return paths[folder]
+
+
+assets = AssetManifest(ASSET_MANIFEST)
+
+
+class TtlLruCache:
+    """Потокобезопасный LRU-кэш с ограничением времени жизни записей."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class ReferenceData:
+    """Справочники levels, achieves, proof_types и action_types.
+
+    Они заполняются в init_db и не меняются во время работы, поэтому читаются из базы один раз при старте.
+    """
 
-db_engine = DbEngine()
+    def __init__(self):
+        self.levels = {}
+        self.achieves = {}
+        self.proof_types = {}  # name -> proof_id
+        self.action_types = {}  # name -> action_id
+
+    def load(self):
+        for table, key, name in db_engine.fetchall('reference_data'):
+            if table in ('levels', 'achieves'):
+                getattr(self, table)[key] = name
+            else:
+                getattr(self, table)[name] = key
+
+
+class UserStateStore:
+    """Кто из пользователей ждёт загрузки фото или видео после /check или /debt.
+
+    Копия user_states в памяти: загружается при старте, изменения пишутся сначала в базу, потом сюда.
+    Медиа от остальных пользователей отбрасываются без запроса к базе. Записи старше ttl
+    перепроверяются по базе на случай, если её поменял кто-то кроме этого процесса.
+
+    В режиме supervisor пользователь может сдать /check в чате одного процесса, а фото прислать в чат
+    другого. Для этого процессы делят shared - массив счётчиков в общей памяти, индекс - user_id по модулю
+    длины. Ненулевой счётчик значит, что пользователь, возможно, ждёт загрузки, и тогда ожидание
+    снимается в базе атомарно через take_user_state; нулевой - что не ждёт точно.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.shared = None  # multiprocessing.Array в режиме supervisor
+        self._awaiting = {}  # user_id -> (expires_at, task_type)
+        self._lock = threading.Lock()
+        self.avoided = 0
+        self.hits = 0
+        self.revalidations = 0
+
+    def load(self):
+        expires_at = time.monotonic() + self.ttl
+        awaiting = {user_id: (expires_at, task_type) for user_id, task_type in db_engine.fetchall('awaiting_user_states')}
+        with self._lock:
+            self._awaiting = awaiting
+        return awaiting
+
+    def set_awaiting(self, user_id, task_type):
+        prev_state = db_engine.fetchone('set_user_state', user_id, 1, task_type)[0]
+        with self._lock:
+            self._awaiting[user_id] = (time.monotonic() + self.ttl, task_type)
+        if self.shared is not None and prev_state != 1:
+            with self.shared.get_lock():
+                self.shared[user_id % len(self.shared)] += 1
+
+    def take(self, user_id):
+        """Снимает ожидание и возвращает task_type, либо None, если пользователь ничего не сдаёт."""
+        with self._lock:
+            item = self._awaiting.pop(user_id, None)
+            if item is None and (self.shared is None or self.shared[user_id % len(self.shared)] == 0):
+                self.avoided += 1
+                return None
+            if item is not None and item[0] >= time.monotonic() and self.shared is None:
+                self.hits += 1
+                task_type = item[1]
+            else:
+                self.revalidations += 1
+                task_type = None
+        if task_type is None:
+            user_state = db_engine.fetchone('take_user_state', user_id)
+            if user_state is None:
+                return None
+            task_type = user_state[0]
+        else:
+            db_engine.execute('set_user_state', user_id, 0, None)
+        if self.shared is not None:
+            with self.shared.get_lock():
+                slot = user_id % len(self.shared)
+                self.shared[slot] = max(self.shared[slot] - 1, 0)
+        return task_type
+
+    def stats(self):
+        with self._lock:
+            return {'awaiting': len(self._awaiting), 'avoided': self.avoided, 'hits': self.hits,
+                    'revalidations': self.revalidations}
+
+
+reference = ReferenceData()
+chat_members = TtlLruCache(CHAT_MEMBER_CACHE_SIZE, CHAT_MEMBER_CACHE_TTL)
+love_members = TtlLruCache(LOVE_CACHE_SIZE, LOVE_CACHE_TTL)  # chat_id -> [(user_id, подпись кнопки)]
+user_states = UserStateStore(USER_STATE_TTL)
+
+
+def get_chat_user(chat_id, user_id):
+    user = chat_members.get((chat_id, user_id))
+    if user is None:
+        user = bot.get_chat_member(chat_id, user_id).user
+        chat_members.put((chat_id, user_id), user)
+    return user
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        """Берёт токен и возвращает 0, либо возвращает, сколько секунд ждать следующего."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Outbox:
+    """Очередь исходящих сообщений с ограничением частоты.
+
+    Telegram ограничивает бота примерно 30 сообщениями в секунду, 20 в минуту на группу и одним в секунду
+    на личный чат. У каждого чата своя очередь и своё ведро токенов, плюс общее ведро на весь бот;
+    сообщения одного чата уходят строго по порядку, разные чаты отправляются параллельно в OUTBOX_WORKERS
+    потоков. На 429 чат откладывается на retry_after секунд. Несколько ответов подряд на одно и то же
+    сообщение, успевших накопиться в очереди, склеиваются в один. put и reply возвращают Future
+    с результатом отправки. Статус чата (chat_action) в лимиты сообщений не входит и отправляется
+    отдельными потоками без ожидания.
+    """
+
+    def __init__(self, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                 workers=OUTBOX_WORKERS):
+        self.chat_rate = chat_rate / 60
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self._global = TokenBucket(global_rate, global_rate)
+        self._global_lock = threading.Lock()
+        self._chats = {}  # chat_id -> TokenBucket
+        self._pending = {}  # chat_id -> deque сообщений; чат есть здесь, пока у него есть что отправлять
+        self._ready = []  # куча (когда можно отправлять, номер, chat_id)
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._threads = []
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=10000)  # от постановки в очередь до ответа Telegram
+        self._actions = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-action')
+        self._action_slots = threading.BoundedSemaphore(OUTBOX_ACTION_BACKLOG)
+        self.actions_dropped = 0
+
+    def set_global_rate(self, rate):
+        with self._global_lock:
+            self._global = TokenBucket(rate, max(rate, 1))
+
+    def put(self, chat_id, send_function, *args, **kwargs):
+        return self._put(chat_id, [Future(), send_function, args, kwargs, time.monotonic(), None, 0])
+
+    def reply(self, message, text):
+        # reply_key: такие сообщения можно склеить с соседними ответами на то же сообщение
+        return self._put(message.chat.id,
+                         [Future(), bot.reply_to, (message, text), {}, time.monotonic(), message.id, 0])
+
+    def chat_action(self, chat_id, action='typing'):
+        # обработчик отправку не ждёт; если Telegram не успевает, устаревший статус лучше не отправлять вовсе
+        if not self._action_slots.acquire(blocking=False):
+            self.actions_dropped += 1
+            return
+        self._actions.submit(self._send_action, chat_id, action)
+
+    def _send_action(self, chat_id, action):
+        try:
+            bot.send_chat_action(chat_id, action)
+        except Exception as e:
+            root_logger.warning(f'outbox send_chat_action => {e}')
+        finally:
+            self._action_slots.release()
+
+    def _put(self, chat_id, item):
+        with self._cond:
+            items = self._pending.get(chat_id)
+            if items is None:
+                items = self._pending[chat_id] = deque()
+                self._schedule(chat_id, time.monotonic())
+            items.append(item)
+            self.queued += 1
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        return item[0]
+
+    def _schedule(self, chat_id, ready_at):
+        self._seq += 1
+        heapq.heappush(self._ready, (ready_at, self._seq, chat_id))
+        self._cond.notify()
+
+    def _next_chat(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    chat_id = heapq.heappop(self._ready)[2]
+                    chat_bucket = self._chats.get(chat_id)
+                    if chat_bucket is None:
+                        rate, burst = (self.chat_rate, self.chat_burst) if chat_id < 0 else (1, 1)
+                        chat_bucket = self._chats[chat_id] = TokenBucket(rate, burst)
+                    delay = chat_bucket.delay()
+                    if delay > 0:
+                        self._schedule(chat_id, now + delay)
+                        continue
+                    return chat_id, self._take(chat_id)
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _take(self, chat_id):
+        items = self._pending[chat_id]
+        batch = [items.popleft()]
+        reply_key = batch[0][5]
+        if reply_key is not None:
+            text_len = len(batch[0][2][1])
+            while items and items[0][5] == reply_key and text_len + len(items[0][2][1]) < 4096:
+                text_len += len(items[0][2][1]) + 1
+                batch.append(items.popleft())
+        self.queued -= len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            chat_id, batch = self._next_chat()
+            with self._global_lock:
+                delay = self._global.delay()
+                while delay > 0:
+                    time.sleep(delay)
+                    delay = self._global.delay()
+
+            future, send_function, args, kwargs, enqueued_at, reply_key, attempts = batch[0]
+            if len(batch) > 1:
+                args = (args[0], '\n'.join(item[2][1] for item in batch))
+            retry_at = None
+            try:
+                result = send_function(*args, **kwargs)
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 429 and attempts < OUTBOX_MAX_RETRIES:
+                    retry_at = time.monotonic() + e.result_json.get('parameters', {}).get('retry_after', 1)
+                else:
+                    self._fail(batch, send_function, e)
+            except Exception as e:
+                self._fail(batch, send_function, e)
+            else:
+                now = time.monotonic()
+                for item in batch:
+                    self.latencies.append(now - item[4])
+                    OUTBOX_SEND_SECONDS.observe(now - item[4])
+                    item[0].set_result(result)
+                self.sent += 1
+                self.coalesced += len(batch) - 1
+
+            with self._cond:
+                if retry_at is not None:
+                    self.retries += 1
+                    for item in reversed(batch):
+                        item[6] += 1
+                        self._pending[chat_id].appendleft(item)
+                    self.queued += len(batch)
+                    self._schedule(chat_id, retry_at)
+                elif self._pending[chat_id]:
+                    self._schedule(chat_id, time.monotonic())
+                else:
+                    del self._pending[chat_id]
+                    if not self._pending:
+                        self._cond.notify_all()  # для drain
+
+    def drain(self, timeout):
+        """Ждёт, пока всё поставленное в очередь будет отправлено, но не дольше timeout секунд."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return not self._pending
+
+    def _fail(self, batch, send_function, e):
+        root_logger.error(f'outbox {send_function.__name__} => {e}')
+        self.failed += len(batch)
+        for item in batch:
+            item[0].set_exception(e)
+
+    def stats(self):
+        stats = {'queued': self.queued, 'chats': len(self._pending), 'sent': self.sent, 'failed': self.failed,
+                 'coalesced': self.coalesced, 'retries': self.retries, 'actions_dropped': self.actions_dropped}
+        if self.latencies:
+            p50, p99 = np.percentile(np.fromiter(self.latencies, dtype=float), [50, 99])
+            stats['latency_p50_ms'] = round(p50 * 1000, 2)
+            stats['latency_p99_ms'] = round(p99 * 1000, 2)
+        return stats
+
+
+OUTBOX_SEND_SECONDS = REGISTRY.histogram('outbox_send_seconds', 'От постановки в очередь до ответа Telegram',
+                                         buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)).labels()
+outbox = Outbox()
 
 
 def exception_catcher(base_function):
@@ -66,414 +585,1076 @@ def exception_catcher(base_function):
 
 @exception_catcher
 def init_db():
-    cur = db_engine.get_cursor()
-    # Create tables
-
-    cur.execute('''CREATE TABLE IF NOT EXISTS user_levels
-                (user_id bigint PRIMARY KEY, level integer, firstname text, username text);''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS user_states
-                (user_id bigint PRIMARY KEY, state integer, task_type text);''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS achieves
-                (achieve_id integer PRIMARY KEY, name text);''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS levels
-                (level integer PRIMARY KEY, name text);''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS ratings
-                (user_id bigint PRIMARY KEY, rating REAL);''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS action_types
-                (action_id integer PRIMARY KEY, name text);''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS proof_types
-                (proof_id integer PRIMARY KEY, name text);''')
-
-    cur.execute('''INSERT INTO action_types(action_id, name) VALUES ('0', 'task') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO action_types(action_id, name) VALUES ('1', 'pass') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO action_types(action_id, name) VALUES ('2', 'force major') ON CONFLICT DO NOTHING;''')
-
-    cur.execute('''INSERT INTO proof_types(proof_id, name) VALUES ('0', 'photo') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO proof_types(proof_id, name) VALUES ('1', 'video') ON CONFLICT DO NOTHING;''')
-
-    cur.execute('''INSERT INTO achieves(achieve_id, name) VALUES ('0', 'Ранняя пташка') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO achieves(achieve_id, name) VALUES ('1', 'Дневная бабочка') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO achieves(achieve_id, name) VALUES ('2', 'Поздняя пташка') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO achieves(achieve_id, name) VALUES ('3', 'Ночная бабочка') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO achieves(achieve_id, name) VALUES ('4', 'Фотоохотник') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO achieves(achieve_id, name) VALUES ('5', 'Сам себе режиссёр') ON CONFLICT DO NOTHING;''')
-
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('0',  'Киберспортмен') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('1',  'Зелёный') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('2',  'Подтянутый') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('3',  'Фитоняш') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('4',  'Стальный мышцы') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('5',  'Мощный') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('6',  'Опытный боец') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('7',  'Победитель по жизни') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('8',  'Мастер') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('9',  'Гуру') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('10', 'Тибетский монах') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('11', 'Легендарный') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('12', 'Бесконечность не предел') ON CONFLICT DO NOTHING;''')
-    cur.execute('''INSERT INTO levels(level, name) VALUES ('13', 'Спортивный маньяк') ON CONFLICT DO NOTHING;''')
-
-    cur.execute('''CREATE TABLE IF NOT EXISTS activity
-                (user_id bigint NOT NULL, date text, time text, action_id integer REFERENCES action_types(action_id), 
-                proof_id integer REFERENCES proof_types(proof_id), chat_id bigint,
-                UNIQUE(user_id,date) );''')
-    cur.execute('''CREATE TABLE IF NOT EXISTS user_achieves
-                (user_id bigint NOT NULL, achieve_id integer REFERENCES achieves(achieve_id),
-                UNIQUE(user_id, achieve_id));''')
+    with db_engine.cursor() as cur:
+        create_schema(cur)
+    load_caches()
 
     root_logger.info('DB initialized')
 
 
+def load_caches():
+    reference.load()
+    media_cache.load()
+    user_states.load()
+    assets.load()
+
+
 @exception_catcher
 @bot.message_handler(commands=['start'])
+@instrument
 def send_welcome(message):
-    bot.send_chat_action(message.chat.id, 'typing')
-    bot.reply_to(message, f'Я твой личный помощник. Приятно познакомиться, {message.from_user.first_name}. '
+    outbox.chat_action(message.chat.id)
+    outbox.reply(message, f'Я твой личный помощник. Приятно познакомиться, {message.from_user.first_name}. '
                           f'Для ознакомления с функционалом выполни /help')
 
 
 @exception_catcher
 @bot.message_handler(commands=['help'])
+@instrument
 def send_help(message):
-    bot.send_chat_action(message.chat.id, 'typing')
-    bot.reply_to(message, '/check - сдать тренировку\n' 
+    outbox.chat_action(message.chat.id)
+    outbox.reply(message, '/check - сдать тренировку\n' 
                           '/debt - отработать долг за вчера\n'
                           '/gift - узнать, кому дарить подарочек\n'
                           '/love - поблагодарить за подарочек\n'
                           '/plan - получить задание\n'
                           '/start - начать\n'
-                          '/stat - запросить свою статистику')
+                          '/stat - запросить свою статистику\n'
+                          '/top - рейтинг чата')
 
 
 @exception_catcher
 @bot.message_handler(commands=['check'])
+@instrument
 def send_check(message):
-    bot.send_chat_action(message.chat.id, 'typing')
+    outbox.chat_action(message.chat.id)
 
     date_time = datetime.fromtimestamp(message.date, timezone('Europe/Moscow'))
-    date_str = date_time.strftime("%m/%d/%Y")
 
-    cur_thread = db_engine.get_cursor()
-    cur_thread.execute(f'''SELECT * FROM activity WHERE user_id={message.from_user.id} AND date='{date_str}';''')
-    exist_activity = cur_thread.fetchone()
-    if exist_activity is not None and len(exist_activity) != 0:
-        bot.reply_to(message, 'Запись о твоей активности уже есть :)')
+    exist_activity = db_engine.fetchone('activity_on_day', message.from_user.id, date_time.date())
+    if exist_activity is None:
+        user_states.set_awaiting(message.from_user.id, 'check')
+
+    if exist_activity is not None:
+        outbox.reply(message, 'Запись о твоей активности уже есть :)')
     else:
-        cur_thread.execute(f'''INSERT INTO user_states VALUES ({message.from_user.id}, 1, 'check') 
-                               ON CONFLICT (user_id) DO UPDATE SET 
-                               state = EXCLUDED.state,
-                               task_type = EXCLUDED.task_type;''')
-        bot.reply_to(message, 'Просто загрузи фото или видео :)')
+        outbox.reply(message, 'Просто загрузи фото или видео :)')
 
 
 @exception_catcher
 @bot.message_handler(commands=['debt'])
+@instrument
 def send_debt(message):
-    bot.send_chat_action(message.chat.id, 'typing')
+    outbox.chat_action(message.chat.id)
 
     date_time = datetime.fromtimestamp(message.date, timezone('Europe/Moscow')) - timedelta(days=1)
-    date_str = date_time.strftime("%m/%d/%Y")
 
-    cur_thread = db_engine.get_cursor()
-    cur_thread.execute(f'''SELECT * FROM activity WHERE user_id={message.from_user.id} AND date='{date_str}';''')
-    exist_activity = cur_thread.fetchone()
-    if exist_activity is not None and len(exist_activity) != 0:
-        bot.reply_to(message, 'Запись о твоей активности уже есть :)')
+    exist_activity = db_engine.fetchone('activity_on_day', message.from_user.id, date_time.date())
+    if exist_activity is None:
+        user_states.set_awaiting(message.from_user.id, 'debt')
+
+    if exist_activity is not None:
+        outbox.reply(message, 'Запись о твоей активности уже есть :)')
     else:
-        cur_thread.execute(f'''INSERT INTO user_states VALUES ({message.from_user.id}, 1, 'debt') 
-                               ON CONFLICT (user_id) DO UPDATE SET 
-                               state = EXCLUDED.state,
-                               task_type = EXCLUDED.task_type;''')
-        bot.reply_to(message, 'Просто загрузи фото или видео :)')
+        outbox.reply(message, 'Просто загрузи фото или видео :)')
 
 
 @exception_catcher
 def change_rating(user_id, change_val):
-    cur_thread = db_engine.get_cursor()
-    cur_thread.execute(f'''SELECT rating FROM ratings WHERE user_id={user_id};''')
-    curr_rating = cur_thread.fetchone()
+    curr_rating = db_engine.fetchone('change_rating', user_id, change_val)[0]
+    return curr_rating
 
-    if curr_rating is not None and len(curr_rating) != 0:
-        curr_rating = curr_rating[0]
-    else:
-        curr_rating = 100.0
 
-    if change_val != 0:
-        curr_rating = curr_rating + change_val
+class RatingBuffer:
+    """Отложенная запись изменений кармы.
+
+    Изменения копятся в памяти и раз в RATING_FLUSH_INTERVAL секунд записываются одним запросом, так что
+    серия /love одному пользователю превращается в одну запись. При RATING_FLUSH_INTERVAL=0 буфер выключен
+    и каждое изменение сразу уходит в change_rating. Остаток сбрасывается при завершении процесса.
+    """
+
+    def __init__(self, interval=RATING_FLUSH_INTERVAL):
+        self.interval = interval
+        self._deltas = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.flushes = 0
+        self.coalesced = 0
+        atexit.register(self.flush)
+
+    def add(self, user_id, change_val):
+        if self.interval <= 0:
+            change_rating(user_id, change_val)
+            return
+
+        with self._lock:
+            if user_id in self._deltas:
+                self.coalesced += 1
+            self._deltas[user_id] = self._deltas.get(user_id, 0) + change_val
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='rating-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return
 
-    curr_rating = min(max(curr_rating, 0), 100)
-    cur_thread.execute(f'''INSERT INTO ratings VALUES ({user_id}, {curr_rating}) 
-                           ON CONFLICT (user_id) DO UPDATE SET 
-                           rating = EXCLUDED.rating;''')
+        try:
+            self._write(deltas)
+        except psycopg2.Error as e:
+            root_logger.error(f'rating flush => {e}')
+            with self._lock:  # вернём изменения в буфер, запишем со следующей попыткой
+                for user_id, change_val in deltas.items():
+                    self._deltas[user_id] = self._deltas.get(user_id, 0) + change_val
+            return
+        self.flushes += 1
 
-    return curr_rating
+    @staticmethod
+    def _write(deltas):
+        db_engine.execute('change_ratings', list(deltas.keys()), list(deltas.values()))
+
+
+rating_buffer = RatingBuffer()
 
 
 @exception_catcher
 @bot.message_handler(commands=['plan'])
+@instrument
 def send_plan(message):
-    bot.send_chat_action(message.chat.id, 'typing')
-    gif_filenames = os.listdir('training')
-    gif_perm = np.random.permutation(len(gif_filenames))
+    outbox.chat_action(message.chat.id)
+    gif_paths = assets.paths('training')
+    gif_perm = np.random.permutation(len(gif_paths))
     for i in range(3):
-        gif_file = open('training/' + gif_filenames[gif_perm[i]], 'rb')
-        bot.send_animation(message.chat.id, gif_file, message.id)
+        outbox.put(message.chat.id, media_cache.send, bot.send_animation, message.chat.id,
+                   gif_paths[gif_perm[i]], message.id)
 
 
 @exception_catcher
 @bot.message_handler(commands=['gift'])
+@instrument
 def send_gift(message):
-    bot.send_chat_action(message.chat.id, 'typing')
+    outbox.chat_action(message.chat.id)
 
-    cur_thread = db_engine.get_cursor()
-    cur_thread.execute(f'''SELECT DISTINCT user_id FROM activity WHERE user_id!={message.from_user.id} 
-                       AND chat_id={message.chat.id}''')
-    users_gift = cur_thread.fetchall()
-
-    if users_gift is None or len(users_gift) == 0:
-        bot.reply_to(message, 'Некому дарить подарочек(')
+    users_gift = db_engine.fetchall('gift_candidates', message.from_user.id, message.chat.id)
+    if len(users_gift) == 0:
+        outbox.reply(message, 'Некому дарить подарочек(')
         return
 
     user_gift_id = randint(0, len(users_gift) - 1)
     user_gift_id = users_gift[user_gift_id][0]
 
-    chat_member = bot.get_chat_member(message.chat.id, user_gift_id)
-    bot.reply_to(message, f'Подарочек нужно подарить {chat_member.user.first_name} ({chat_member.user.username}) :)')
+    user_gift = get_chat_user(message.chat.id, user_gift_id)
+    outbox.reply(message, f'Подарочек нужно подарить {user_gift.first_name} ({user_gift.username}) :)')
 
 
 @exception_catcher
 @bot.message_handler(commands=['stat'])
+@instrument
 def send_stat(message):
-    bot.send_chat_action(message.chat.id, 'typing')
-
-    cur_thread = db_engine.get_cursor()
-    cur_thread.execute(f'''SELECT * FROM activity WHERE user_id={message.from_user.id} 
-                                                    AND chat_id={message.chat.id} 
-                                                    AND action_id=0''')
-    user_stat = cur_thread.fetchall()
-    if len(user_stat) == 0:
-        bot.reply_to(message, 'Чтобы увидеть статистику загрузи свою первую тренировку!')
-        return
-
-    first_train = user_stat[0]
-    last_train = user_stat[-1]
+    outbox.chat_action(message.chat.id)
 
-    if len(first_train) < 6 or len(last_train) < 6:
-        return
+    task_count, datetime_interval, level_curr, rating_curr, user_achieves = db_engine.fetchone(
+        'user_stat', message.from_user.id, message.chat.id)
 
-    if first_train[1] is None or last_train[1] is None:
+    if task_count == 0:
+        outbox.reply(message, 'Чтобы увидеть статистику загрузи свою первую тренировку!')
         return
 
-    datetime_first = datetime.strptime(first_train[1], '%m/%d/%Y')
-    datetime_last = datetime.strptime(last_train[1], '%m/%d/%Y')
-    datetime_interval = int(str(datetime_last - datetime_first).split()[0])
-
-    task_count = len(user_stat)
-    pass_count = max(datetime_interval - task_count, 0)
-
-    cur_thread.execute(f'''SELECT level FROM user_levels WHERE user_id={message.from_user.id}''')
-    level_curr = cur_thread.fetchone()
+    pass_count = max((datetime_interval or 0) - task_count, 0)
 
     message_str = ''
     message_str = message_str + f'Кол-во занятий:      {task_count},\n'
     message_str = message_str + f'Кол-во пропусков:    {pass_count}'
-
-    rating_curr = change_rating(message.from_user.id, 0) #чтоб избежать отсутствия рейтинга
     message_str = message_str + '\n' + f'Твоя карма: {rating_curr}'
 
-    if level_curr is not None and len(level_curr) != 0:
-        cur_thread.execute(f'''SELECT name FROM levels WHERE level={level_curr[0]}''')
-        level_name = cur_thread.fetchone()
-        message_str = message_str + '\n' + f'Твой уровень: {level_curr[0]}'
-        if level_name is not None and len(level_name) != 0:
-            message_str = message_str + f' ({level_name[0]})'
-
-    cur_thread.execute(f'''SELECT name FROM user_achieves INNER JOIN achieves 
-                        ON user_achieves.achieve_id=achieves.achieve_id AND user_id={message.from_user.id}''')
-    user_achieves = cur_thread.fetchall()
+    if level_curr is not None:
+        message_str = message_str + '\n' + f'Твой уровень: {level_curr}'
+        if level_curr in reference.levels:
+            message_str = message_str + f' ({reference.levels[level_curr]})'
 
-    for user_achieve in user_achieves:
-        message_str = message_str + '\n' + f'Есть достижение: {user_achieve[0]}'
+    for achieve_id in user_achieves:
+        message_str = message_str + '\n' + f'Есть достижение: {reference.achieves.get(achieve_id)}'
 
-    bot.reply_to(message, message_str)
+    outbox.reply(message, message_str)
 
 
 @exception_catcher
-def give_achieve(user_id, chat_id, cur_thread):
-    # выясним какое достижение можно выдать
-    cur_thread.execute(f'''SELECT * FROM activity WHERE user_id={user_id} AND action_id=0 AND chat_id={chat_id};''')
-    tasks = cur_thread.fetchall()
-    level_step = 30  # month
-    calc_level = int(len(tasks) / level_step)
-
-    if len(tasks) == 0:
-        return ''
-
-    chat_member = bot.get_chat_member(chat_id, user_id)
-
-    cur_thread.execute(f'''SELECT name FROM levels WHERE level={calc_level}''')
-    level_name = cur_thread.fetchone()
-
-    cur_thread.execute(f'''SELECT level FROM user_levels WHERE user_id={user_id}''')
-    level_curr = cur_thread.fetchone()
-    cur_thread.execute(f'''INSERT INTO user_levels VALUES ({user_id}, {calc_level}) 
-                       ON CONFLICT (user_id) DO UPDATE SET 
-                       level = EXCLUDED.level, 
-                       firstname = '{chat_member.user.first_name}', 
-                       username = '{chat_member.user.username}';''')
+def give_achieve(user_id, chat_id, counters):
+    # уровень и достижения выводятся из счётчиков user_counters, история activity не перечитывается
+    tasks = counters[0]
+    calc_level = int(tasks / LEVEL_STEP)
+
+    chat_user = get_chat_user(chat_id, user_id)
+    level_curr = db_engine.fetchone('upsert_user_level', user_id, calc_level,
+                                    chat_user.first_name, chat_user.username)[0]
+    members = love_members.get(chat_id)
+    if members is not None and (user_id, love_label(chat_user.first_name, chat_user.username)) not in members:
+        love_members.invalidate(chat_id)  # новый участник или сменилось имя
 
     achieve_str = ''
-    if level_curr is None or (len(level_curr) > 0 and level_curr[0] != calc_level):
-        if level_name is None:
+    if level_curr != calc_level:
+        if calc_level not in reference.levels:
             achieve_str = f'Уровень {calc_level}\n'
-        elif len(level_name) > 0:
-            achieve_str = f'Уровень {calc_level} : {level_name[0]}\n'
-
-    achieve_counts = [0, 0, 0, 0, 0, 0]
-
-    for task in tasks:
-        if task is None or len(task) < 6:
-            continue
-
-        if '04:00:00' < task[2] <= '11:00:00':
-            achieve_counts[0] += 1
-        elif '11:00:00' < task[2] <= '15:00:00':
-            achieve_counts[1] += 1
-        elif '15:00:00' < task[2] <= '23:00:00':
-            achieve_counts[2] += 1
-        elif '23:00:00' < task[2] <= '04:00:00':
-            achieve_counts[3] += 1
-
-        if task[4] == 0:
-            achieve_counts[4] += 1
-        elif task[4] == 1:
-            achieve_counts[5] += 1
-
-    for achieve_ctr in range(len(achieve_counts)):
-        if achieve_counts[achieve_ctr] >= 20:
-            cur_thread.execute(f'''SELECT * FROM user_achieves WHERE user_id={user_id} AND achieve_id={achieve_ctr}''')
-            achieve_existed = cur_thread.fetchone()
-            if achieve_existed is not None:
-                continue
-
-            try:
-                cur_thread.execute(f'''INSERT INTO user_achieves VALUES ({user_id},'{achieve_ctr}') 
-                                   ON CONFLICT DO NOTHING''')
-                cur_thread.execute(f'''SELECT name FROM achieves WHERE achieve_id={achieve_ctr}''')
-                achieve_name = cur_thread.fetchone()
-                if achieve_name is not None and len(achieve_name) > 0:
-                    achieve_str += f'Достижение: {achieve_name[0]}\n'
+        else:
+            achieve_str = f'Уровень {calc_level} : {reference.levels[calc_level]}\n'
 
-            except psycopg2.IntegrityError:
-                root_logger.error('Achieve already exists!')
+    achieve_ids = [achieve_id for achieve_id, count in enumerate(counters[1:]) if count >= ACHIEVE_STEP]
+    if achieve_ids:
+        granted = db_engine.fetchall('grant_achieves', user_id, achieve_ids)
+        for achieve_id in sorted(row[0] for row in granted):
+            achieve_str += f'Достижение: {reference.achieves.get(achieve_id)}\n'
 
     return achieve_str
 
 
 @exception_catcher
 @bot.message_handler(content_types=['photo', 'video'])
+@instrument
 def get_media_messages(message):
-
-    cur_thread = db_engine.get_cursor()
-    cur_thread.execute(f'''SELECT * FROM user_states WHERE user_id={message.from_user.id};''')
-    user_state = cur_thread.fetchone()
-
-    if user_state is None or (len(user_state) != 0 and user_state[1] != 1):
+    task_type = user_states.take(message.from_user.id)
+    if task_type is None:
         return
 
-    cur_thread.execute(f'''INSERT INTO user_states VALUES ({message.from_user.id}, 0) 
-                           ON CONFLICT (user_id) DO UPDATE SET 
-                           state = EXCLUDED.state,
-                           task_type = EXCLUDED.task_type;''')
+    chat_members.put((message.chat.id, message.from_user.id), message.from_user)  # give_achieve не пойдёт в Telegram
 
-    bot.send_chat_action(message.chat.id, 'typing')
+    outbox.chat_action(message.chat.id)
     if message.photo is None and message.video is None:
-        bot.reply_to(message, 'Неправильный формат, попробуй ещё раз :)')
+        outbox.reply(message, 'Неправильный формат, попробуй ещё раз :)')
         return
     else:
-        cur_thread = db_engine.get_cursor()
         date_time = datetime.fromtimestamp(message.date, timezone('Europe/Moscow'))
 
-        if user_state[2] == 'debt':
+        if task_type == 'debt':
             date_time = date_time - timedelta(days=1)
 
-        date_time_req = date_time - timedelta(days=1)
-
-        date_str = date_time.strftime("%m/%d/%Y")
-        time_str = date_time.strftime("%H:%M:%S")
-
         proof_name = ''
         if message.photo is not None:
             proof_name = 'photo'
         elif message.video is not None:
             proof_name = 'video'
-        cur_thread.execute(f'''SELECT proof_id FROM proof_types WHERE name='{proof_name}' LIMIT 1''')
-        proof_id = cur_thread.fetchone()
+        proof_id = reference.proof_types.get(proof_name)
 
-        if proof_id is not None and len(proof_id) == 1:
+        counters = None
+        if proof_id is not None:
             try:
-                cur_thread.execute(
-                    f'''INSERT INTO activity VALUES ({message.from_user.id},'{date_str}','{time_str}',{0},
-                    {proof_id[0]},{message.chat.id})''')
+                counters = db_engine.fetchone('record_task', message.from_user.id, reference.action_types['task'],
+                                              proof_id, message.chat.id, date_time)
             except psycopg2.IntegrityError:
                 root_logger.error('Record already added')
                 return
 
-        bot.reply_to(message, f'Умничка, {message.from_user.first_name}, засчитано!')
+        outbox.reply(message, f'Умничка, {message.from_user.first_name}, засчитано!')
         change_rating(message.from_user.id, +1)
 
-        achieve_name = give_achieve(message.from_user.id, message.chat.id, cur_thread)
+        achieve_name = None
+        if counters is not None:
+            achieve_name = give_achieve(message.from_user.id, message.chat.id, counters)
         if achieve_name is not None and len(achieve_name) > 0:
-            bot.reply_to(message, f'{message.from_user.first_name}, лэвэл ап! Так держать!')
-            bot.reply_to(message, f'{achieve_name}')
+            outbox.reply(message, f'{message.from_user.first_name}, лэвэл ап! Так держать!')
+            outbox.reply(message, f'{achieve_name}')
+
+            sticker_paths = assets.paths('stickers')
+            sticker_number = randint(0, len(sticker_paths) - 1)
+            outbox.put(message.chat.id, media_cache.send, bot.send_sticker, message.chat.id,
+                       sticker_paths[sticker_number], message.id)
+
 
-            sticker_filenames = os.listdir('stickers')
-            sticker_number = randint(0, len(sticker_filenames) - 1)
-            sticker = open('stickers/' + sticker_filenames[sticker_number], 'rb')
-            bot.send_sticker(message.chat.id, sticker, message.id)
+LOVE_CALLBACK = re.compile(r'love:(\d{1,19})')
+LOVE_PAGE_CALLBACK = re.compile(r'love_page:(\d{1,4}):(\d{1,19})')  # страница и автор /love
 
-        date_time_req_str = date_time_req.strftime("%m/%d/%Y")
-        cur_thread.execute(f'''SELECT date FROM activity WHERE user_id={message.from_user.id} 
-                                                           AND chat_id={message.chat.id} 
-                                                           AND date='{date_time_req_str}';''')
 
-        user_activities = cur_thread.fetchall()
+def love_label(firstname, username):
+    return f'{firstname} ({username})'
 
-        if (user_activities is None) or (len(user_activities) == 0):
-            bot.reply_to(message, 'Похоже ты пропустил занятие, друг мой)) Подари подарок!)')
-            send_gift(message)
-            change_rating(message.from_user.id, -5)
+
+def chat_love_members(chat_id):
+    members = love_members.get(chat_id)
+    if members is None:
+        members = [(user_id, love_label(firstname, username))
+                   for user_id, firstname, username in db_engine.fetchall('chat_love_members', chat_id)
+                   if firstname is not None or username is not None]  # bot
+        love_members.put(chat_id, members)
+    return members
+
+
+def love_markup(chat_id, user_id, page):
+    members = [member for member in chat_love_members(chat_id) if member[0] != user_id]
+    pages = max((len(members) + LOVE_PAGE_SIZE - 1) // LOVE_PAGE_SIZE, 1)
+    page = min(page, pages - 1)
+
+    markup = types.InlineKeyboardMarkup()
+    for member_id, label in members[page * LOVE_PAGE_SIZE:(page + 1) * LOVE_PAGE_SIZE]:
+        markup.row(types.InlineKeyboardButton(label, callback_data=f'love:{member_id}'))
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton('‹', callback_data=f'love_page:{page - 1}:{user_id}'))
+    if page < pages - 1:
+        navigation.append(types.InlineKeyboardButton('›', callback_data=f'love_page:{page + 1}:{user_id}'))
+    if navigation:
+        markup.row(*navigation)
+    return markup, len(members)
 
 
 @exception_catcher
 @bot.message_handler(commands=['love'])
+@instrument
 def send_love(message):
-    markup = types.InlineKeyboardMarkup()
+    markup, members_count = love_markup(message.chat.id, message.from_user.id, 0)
+    if members_count == 0:
+        outbox.reply(message, 'Некого благодарить(')
+        return
+
+    outbox.put(message.chat.id, bot.send_message, message.chat.id, 'Выбери кого поблагодарить ^^', reply_markup=markup)
 
-    cur_thread = db_engine.get_cursor()
-    cur_thread.execute(f'''SELECT DISTINCT user_id, firstname, username FROM user_levels WHERE user_id!={message.from_user.id}''')
-    users_love = cur_thread.fetchall()
 
-    if (users_love is None) or (len(users_love) == 0):
-        bot.reply_to(message, 'Некого благодарить(')
+@bot.callback_query_handler(func=lambda call: LOVE_CALLBACK.fullmatch(call.data or ''))
+@instrument
+def handle_love(call):
+    user_id = int(LOVE_CALLBACK.fullmatch(call.data).group(1))
+    if user_id == call.from_user.id:
+        bot.answer_callback_query(call.id, 'Себя благодарить нельзя :)')
+        return
+    if all(member[0] != user_id for member in chat_love_members(call.message.chat.id)):
+        bot.answer_callback_query(call.id, 'Этого участника нет в чате')
         return
 
-    for user_love in users_love:
-        if user_love[1] is None and user_love[2] is None: #bot
-            continue
+    rating_buffer.add(user_id, +5)
+    outbox.put(call.message.chat.id, bot.send_message, call.message.chat.id, 'Благодарность отправлена <3')
+    bot.answer_callback_query(call.id)
 
-        user_button = types.InlineKeyboardButton(f'{user_love[1]} ({user_love[2]})', callback_data=user_love[0])
-        markup.row(user_button)
 
-    bot.send_message(message.chat.id, 'Выбери кого поблагодарить ^^', reply_markup=markup)
+@bot.callback_query_handler(func=lambda call: LOVE_PAGE_CALLBACK.fullmatch(call.data or ''))
+@instrument
+def handle_love_page(call):
+    # страницы строятся без автора /love, а не без того, кто листает, иначе в общем чате они съезжают
+    page, user_id = map(int, LOVE_PAGE_CALLBACK.fullmatch(call.data).groups())
+    markup, _ = love_markup(call.message.chat.id, user_id, page)
+    outbox.put(call.message.chat.id, bot.edit_message_reply_markup, call.message.chat.id, call.message.message_id,
+               reply_markup=markup)
+    bot.answer_callback_query(call.id)
 
 
 @bot.callback_query_handler(func=lambda call: True)
-def handle_love(call):
-    change_rating(call.data, +5)
-    bot.send_message(call.message.chat.id, 'Благодарность отправлена <3')
-    bot.answer_callback_query(call.id)
+def handle_stale_callback(call):
+    # кнопки старого формата и всё, что не разобрали обработчики выше
+    bot.answer_callback_query(call.id, 'Кнопка устарела, вызови /love ещё раз')
+
+
+def chat_user_name(chat_id, user_id):
+    try:
+        chat_user = get_chat_user(chat_id, user_id)
+    except telebot.apihelper.ApiTelegramException:
+        return str(user_id)  # пользователь ушёл из чата
+    if chat_user.username:
+        return f'{chat_user.first_name} ({chat_user.username})'
+    return chat_user.first_name
+
+
+def send_missed_day_notice(chat_id, day, penalties):
+    lines = [f'{day:%d.%m} пропустили занятие, друзья мои)) Подарите подарки!)']
+    for user_id, gift_user_id in penalties:
+        if gift_user_id is None:
+            lines.append(f'{chat_user_name(chat_id, user_id)}: некому дарить подарочек(')
+        else:
+            lines.append(f'{chat_user_name(chat_id, user_id)} дарит {chat_user_name(chat_id, gift_user_id)}')
+    return bot.send_message(chat_id, '\n'.join(lines))
+
+
+def notify_penalties():
+    # одно сообщение на чат и день, длинное - несколькими частями; notified ставится только после отправки, так что
+    # неотправленное уйдёт при следующем запуске
+    notices = []
+    rows = db_engine.fetchall('unnotified_penalties')
+    for (day, chat_id), group in groupby(rows, key=lambda row: (row[2], row[1])):
+        group = [(user_id, gift_user_id) for user_id, _, _, gift_user_id in group]
+        for i in range(0, len(group), MISSED_DAY_NOTICE_LINES):
+            penalties = group[i:i + MISSED_DAY_NOTICE_LINES]
+            notices.append((day, chat_id, penalties,
+                            outbox.put(chat_id, send_missed_day_notice, chat_id, day, penalties)))
+
+    for day, chat_id, penalties, future in notices:
+        try:
+            future.result()
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code not in (400, 403):  # бота удалили из чата - повторять бесполезно
+                continue
+        except Exception:
+            continue
+        for user_id, _ in penalties:
+            db_engine.execute('mark_penalty_notified', user_id, chat_id, day)
+
+
+def penalize_missed_day(day):
+    penalized = db_engine.fetchone('penalize_missed_day', day, MISSED_DAY_PENALTY, reference.action_types['task'],
+                                   MISSED_DAY_ACTIVE_DAYS)[0]
+    root_logger.info(f'missed day {day}: {penalized} penalties')
+    notify_penalties()
+
+
+def member_streaks(chat_ids, user_ids, days):
+    """Серии тренировок по участникам чатов, векторно по всем тренировкам сразу.
+
+    На входе по элементу на тренировку, дни - целые номера. На выходе по элементу на пару чат/пользователь:
+    chat_id, user_id, число тренировок, последняя серия подряд идущих дней, самая длинная серия, последний день.
+    """
+    if len(days) == 0:
+        return (np.array([], dtype=np.int64),) * 6
+    order = np.lexsort((days, user_ids, chat_ids))
+    chat_ids, user_ids, days = chat_ids[order], user_ids[order], days[order]
+
+    new_member = np.ones(len(days), dtype=bool)
+    new_member[1:] = (chat_ids[1:] != chat_ids[:-1]) | (user_ids[1:] != user_ids[:-1])
+    new_run = new_member.copy()
+    new_run[1:] |= days[1:] != days[:-1] + 1
+
+    member_starts = np.flatnonzero(new_member)
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, len(days)))
+    member_runs = np.flatnonzero(new_member[run_starts])  # первая серия каждого участника
+    return (chat_ids[member_starts], user_ids[member_starts],
+            np.diff(np.append(member_starts, len(days))),
+            run_lengths[np.append(member_runs[1:], len(run_starts)) - 1],
+            np.maximum.reduceat(run_lengths, member_runs),
+            days[np.append(member_starts[1:], len(days)) - 1])
+
+
+def refresh_chat_stats():
+    # пересчитываются только чаты, где появились тренировки, зато каждый - по всей истории:
+    # запоздавшая /debt может склеить две серии
+    refreshed_at, chat_ids = db_engine.fetchone('chat_stats_dirty', reference.action_types['task'])
+    if chat_ids:
+        with db_engine.cursor() as cur:
+            tasks = export_tasks(cur, chat_ids, reference.action_types['task'])
+        stats = member_streaks(*tasks)
+        db_engine.execute('upsert_chat_stats', *(column.tolist() for column in stats), refreshed_at)
+    db_engine.execute('rank_chat_karma')
+    root_logger.info(f'chat_stats refreshed: {len(chat_ids)} chats')
+
+
+def format_chat_top(rows):
+    lines = []
+    for place, (user_id, firstname, username, trainings, current_streak, longest_streak, karma_rank) \
+            in enumerate(rows, 1):
+        name = love_label(firstname, username) if firstname is not None or username is not None else str(user_id)
+        lines.append(f'{place}. {name}: занятий {trainings}, серия {current_streak} (рекорд {longest_streak}), '
+                     f'карма #{karma_rank}')
+    return lines
+
+
+@exception_catcher
+@bot.message_handler(commands=['top'])
+@instrument
+def send_top(message):
+    outbox.chat_action(message.chat.id)
+
+    today = datetime.fromtimestamp(message.date, timezone('Europe/Moscow')).date()
+    rows = db_engine.fetchall('chat_top', message.chat.id, today, TOP_SIZE)
+    if len(rows) == 0:
+        outbox.reply(message, 'Рейтинг появится после первых тренировок в чате :)')
+        return
+
+    outbox.reply(message, '\n'.join(['Топ чата:'] + format_chat_top(rows)))
+
+
+def send_weekly_digests(day):
+    # итоги недели подводятся за воскресенье, в остальные дни задача ничего не делает
+    if day.weekday() != 6:
+        return
+    refresh_chat_stats()
+    # отправленная сводка отмечается в job_runs по чату, так что при повторе дня уйдут только недоставленные
+    sent = {job for (job,) in db_engine.fetchall('job_runs_on_day', day, 'weekly_digest:')}
+    title = f'Итоги недели {day - timedelta(days=6):%d.%m}-{day:%d.%m}:'
+    digests = []
+    for (chat_id,) in db_engine.fetchall('digest_chats', day):
+        if f'weekly_digest:{chat_id}' in sent:
+            continue
+        rows = db_engine.fetchall('chat_top', chat_id, day, DIGEST_SIZE)
+        digests.append((chat_id, outbox.put(chat_id, bot.send_message, chat_id,
+                                            '\n'.join([title] + format_chat_top(rows)))))
+
+    failed = 0
+    for chat_id, future in digests:
+        try:
+            future.result()
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code not in (400, 403):  # бота удалили из чата - повторять бесполезно
+                failed += 1
+                continue
+        except Exception:
+            failed += 1
+            continue
+        db_engine.execute('record_job_run', f'weekly_digest:{chat_id}', day)
+    if failed:
+        # день не отметится в job_runs, и планировщик повторит его при следующем запуске
+        raise RuntimeError(f'weekly digest for {day}: {failed} chats not delivered')
+
+
+class IntervalJob:
+    """Задача, которая выполняется в фоновом потоке сразу после start и дальше раз в interval секунд."""
 
+    def __init__(self, name, function, interval):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
 
-init_db()
-bot.polling(none_stop=True)
+    def _run(self):
+        while True:
+            try:
+                self.function()
+            except Exception as e:
+                root_logger.error(f'{self.name} => {e}')
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+stats_refresher = IntervalJob('chat-stats', refresh_chat_stats, STATS_REFRESH_INTERVAL)
+
+
+class DailyScheduler:
+    """Ежедневные задачи по московским дням.
+
+    Задача получает дату дня, который обрабатывает, и отмечается в job_runs. Если бот был выключен,
+    при следующем запуске пропущенные дни догоняются по порядку; самый первый запуск берёт только
+    последний день. Задачи должны быть идемпотентными: день может обработаться повторно.
+    """
+
+    def __init__(self, run_at=SCHEDULER_RUN_AT):
+        self.hour, self.minute = map(int, run_at.split(':'))
+        self._jobs = []  # (name, function, lag_days)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, name, function, lag_days):
+        self._jobs.append((name, function, lag_days))
+
+    def run_due(self, names=None):
+        """Догоняет все задачи или только задачи из names."""
+        today = datetime.now(timezone('Europe/Moscow')).date()
+        for name, function, lag_days in self._jobs:
+            if names is not None and name not in names:
+                continue
+            target = today - timedelta(days=lag_days)
+            last = db_engine.fetchone('last_job_run', name)[0]
+            day = target if last is None else last + timedelta(days=1)
+            while day <= target:
+                function(day)
+                db_engine.execute('record_job_run', name, day)
+                day += timedelta(days=1)
+
+    def _seconds_until_next_run(self):
+        now = datetime.now(timezone('Europe/Moscow'))
+        next_run = now.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        return (next_run - now).total_seconds()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_due()
+            except Exception as e:
+                root_logger.error(f'scheduler => {e}')
+            self._stop.wait(self._seconds_until_next_run())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+scheduler = DailyScheduler()
+# вчерашний день ещё можно закрыть через /debt, поэтому пропуск окончательный только на второй день
+scheduler.add('missed_day', penalize_missed_day, lag_days=2)
+scheduler.add('weekly_digest', send_weekly_digests, lag_days=1)
+
+for name, documentation, source in (
+        ('db_pool', 'Пул соединений с базой', db_engine.stats),
+        ('outbox', 'Очередь исходящих сообщений', outbox.stats),
+        ('user_states', 'Кэш ожидания загрузки', user_states.stats),
+        ('chat_members_cache', 'Кэш участников чатов', chat_members.stats),
+        ('love_members_cache', 'Кэш клавиатур /love', love_members.stats),
+        ('media_cache', 'Кэш file_id', lambda: {'hits': media_cache.hits, 'uploads': media_cache.uploads}),
+        ('rating_buffer', 'Отложенная запись кармы',
+         lambda: {'flushes': rating_buffer.flushes, 'coalesced': rating_buffer.coalesced})):
+    REGISTRY.gauge(name, documentation, source, labelname='stat')
+
+
+def update_user_id(raw_update):
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if raw_update.get(kind):
+            return raw_update[kind].get('from', {}).get('id')
+    return None
+
+
+def update_chat_id(raw_update):
+    message = raw_update.get('message') or raw_update.get('edited_message') or \
+        (raw_update.get('callback_query') or {}).get('message')
+    if message:
+        return message['chat']['id']
+    return update_user_id(raw_update) or 0
+
+
+def telegram_api_url(method_name):
+    if telebot.apihelper.API_URL:
+        return telebot.apihelper.API_URL.format(token, method_name)
+    return f'https://api.telegram.org/bot{token}/{method_name}'
+
+
+class AsyncRuntime:
+    """Асинхронный приём апдейтов.
+
+    Апдейты из getUpdates (aiohttp) или из вебхука складываются в ограниченную очередь, откуда их
+    разбирает диспетчер. Обработчики выполняются в пуле из ASYNC_WORKERS потоков, так что медленный
+    запрос к Telegram или к базе не останавливает приём. Апдейты одного пользователя обрабатываются
+    строго по очереди, иначе загрузка фото может обогнать /check и user_states.
+    """
+
+    def __init__(self, workers=ASYNC_WORKERS, queue_size=UPDATE_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self._queue = None
+        self._slots = None
+        self._tails = {}
+        self.processed = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=10000)  # от получения апдейта до конца обработки
+        self.handler_latencies = deque(maxlen=10000)  # только работа обработчика
+
+    def start(self):
+        # очередь и семафор должны создаваться внутри работающего цикла событий
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._slots = asyncio.Semaphore(self.workers * 4)
+
+    def offer(self, raw_update):
+        try:
+            self._queue.put_nowait((time.monotonic(), raw_update))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def submit(self, raw_update):
+        await self._queue.put((time.monotonic(), raw_update))  # ждёт, пока в очереди освободится место
+
+    async def dispatcher(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            await self._dispatch(*item)
+
+    async def _dispatch(self, received, raw_update):
+        await self._slots.acquire()
+        user_id = update_user_id(raw_update)
+        prev = self._tails.get(user_id)
+        task = asyncio.ensure_future(self._process(received, raw_update, prev))
+        self._tails[user_id] = task
+
+        def done(finished):
+            self._slots.release()
+            if self._tails.get(user_id) is finished:
+                del self._tails[user_id]
+
+        task.add_done_callback(done)
+
+    async def _process(self, received, raw_update, prev):
+        if prev is not None:
+            await asyncio.wait([prev])
+        update = types.Update.de_json(raw_update)
+        started = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, bot.process_new_updates, [update])
+        except Exception as e:
+            root_logger.error(f'update {raw_update.get("update_id")} => {e}')
+        finished = time.monotonic()
+        self.handler_latencies.append(finished - started)
+        self.latencies.append(finished - received)
+        self.processed += 1
+
+    async def poll(self):
+        offset = None
+        backoff = 3
+        async with aiohttp.ClientSession() as session:
+            while True:
+                try:
+                    async with session.post(telegram_api_url('getUpdates'),
+                                            json={'offset': offset, 'timeout': 20},
+                                            timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                        answer = await resp.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    root_logger.error(f'getUpdates => {e}')
+                    await asyncio.sleep(3)
+                    continue
+
+                if not answer.get('ok'):
+                    # 409 - для бота задан вебхук, 401 - неверный токен: сразу повторять бесполезно
+                    root_logger.error(f'getUpdates => {answer.get("error_code")} {answer.get("description")}')
+                    await asyncio.sleep((answer.get('parameters') or {}).get('retry_after') or backoff)
+                    backoff = min(backoff * 2, 60)
+                    continue
+                backoff = 3
+
+                for raw_update in answer.get('result', []):
+                    offset = raw_update['update_id'] + 1
+                    await self.submit(raw_update)
+
+    async def serve_webhook(self):
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self._on_update)
+        # порт вебхука открыт наружу, поэтому статистика лежит под тем же секретным путём, что и вебхук
+        app.router.add_get(WEBHOOK_PATH + '/stats', self._on_stats)
+        app.router.add_get(WEBHOOK_PATH + '/metrics', self._on_metrics)
+        runner = web.AppRunner(app, access_log=None)  # в пути запроса токен бота, в лог он попасть не должен
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await asyncio.get_running_loop().run_in_executor(None, lambda: bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH))
+        root_logger.info(f'Webhook server listening on port {WEBHOOK_PORT}')
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def _on_update(self, request):
+        try:
+            raw_update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # 503 заставит Telegram повторить доставку позже, когда очередь разгрузится
+        return web.Response(status=200 if self.offer(raw_update) else 503)
+
+    async def _on_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def _on_metrics(self, request):
+        return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+    def stats(self):
+        stats = {'processed': self.processed,
+                 'rejected': self.rejected,
+                 'queued': self._queue.qsize() if self._queue is not None else 0,
+                 'in_flight': len(self._tails)}
+        for name, samples in (('latency', self.latencies), ('handler_latency', self.handler_latencies)):
+            if samples:
+                p50, p99 = np.percentile(np.fromiter(samples, dtype=float), [50, 99])
+                stats[name + '_p50_ms'] = round(p50 * 1000, 2)
+                stats[name + '_p99_ms'] = round(p99 * 1000, 2)
+        stats['user_states'] = user_states.stats()
+        stats['outbox'] = outbox.stats()
+        stats['statements'] = db_engine.statement_stats()
+        return stats
+
+    async def drain(self, dispatcher):
+        await self._queue.put(None)  # диспетчер разберёт то, что уже в очереди, и завершится
+        await dispatcher
+        if self._tails:
+            await asyncio.wait(list(self._tails.values()))
+        self._executor.shutdown(wait=True)
+
+
+def flush_on_exit(timeout=OUTBOX_DRAIN_TIMEOUT):
+    # atexit на SIGTERM не срабатывает, поэтому накопленное в памяти сбрасывается явно:
+    # карма - сразу, исходящие сообщения - сколько успеют за timeout
+    rating_buffer.flush()
+    outbox.drain(timeout)
+
+
+def run_polling():
+    # SIGTERM (так Heroku останавливает dyno) превращается в KeyboardInterrupt, на котором bot.polling
+    # перестаёт запрашивать апдейты; уже полученные доделываются в пуле потоков бота
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        bot.polling(none_stop=True)
+    except KeyboardInterrupt:
+        pass
+    deadline = time.monotonic() + OUTBOX_DRAIN_TIMEOUT
+    while not bot.worker_pool.tasks.empty() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    bot.worker_pool.close()
+    flush_on_exit(max(deadline - time.monotonic(), 0))
+
+
+def run_async(mode):
+    bot.threaded = False  # обработчики запускает AsyncRuntime в своём пуле потоков
+    runtime = AsyncRuntime()
+    REGISTRY.gauge('updates', 'Очередь апдейтов AsyncRuntime', lambda: {
+        key: value for key, value in runtime.stats().items() if not isinstance(value, dict)}, labelname='stat')
+
+    async def main():
+        runtime.start()
+        main_task = asyncio.current_task()
+        # по SIGTERM приём апдейтов отменяется, а то, что уже в очереди, обрабатывается
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+        dispatcher = asyncio.ensure_future(runtime.dispatcher())
+        try:
+            if mode == 'webhook':
+                await runtime.serve_webhook()
+            else:
+                await runtime.poll()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # повторный SIGTERM не должен отменить и сам drain, а без обработчика он завершил бы процесс
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            await runtime.drain(dispatcher)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    flush_on_exit()
+
+
+def worker_main(index, updates, awaiting_slots, log_queue, global_rate):
+    """Процесс-обработчик в режиме supervisor: берёт апдейты своей доли чатов из updates.
+
+    global_rate - доля процесса в общем лимите сообщений Telegram.
+    """
+    # останавливает процесс supervisor, положив None в очередь; сигналы из терминала или от Heroku
+    # не должны обрывать апдейты, которые уже в работе
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    log_listener.stop()
+    atexit.unregister(log_listener.stop)  # повторный stop на выходе из процесса падает
+    root_logger.handlers = [QueueHandler(log_queue)]  # в файл пишет supervisor
+
+    user_states.shared = awaiting_slots
+    outbox.set_global_rate(global_rate)
+    load_caches()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT + 1 + index)
+    bot.threaded = False
+    runtime = AsyncRuntime()
+
+    async def main():
+        runtime.start()
+        dispatcher = asyncio.ensure_future(runtime.dispatcher())
+        loop = asyncio.get_running_loop()
+        while True:
+            raw_update = await loop.run_in_executor(None, updates.get)
+            if raw_update is None:
+                break
+            await runtime.submit(raw_update)
+        # на остановку supervisor ждёт процесс OUTBOX_DRAIN_TIMEOUT, в этот срок укладываются и апдейты, и исходящие
+        deadline = time.monotonic() + OUTBOX_DRAIN_TIMEOUT
+        await runtime.drain(dispatcher)
+        return deadline
+
+    deadline = asyncio.run(main())
+    flush_on_exit(max(deadline - time.monotonic(), 0))
+    root_logger.info(f'worker {index} stopped after {runtime.processed} updates')
+
+
+class Supervisor(AsyncRuntime):
+    """Режим нескольких процессов.
+
+    Supervisor принимает апдейты (long polling или вебхук) и раздаёт их WORKER_PROCESSES процессам по
+    chat_id, так что апдейты одного чата обрабатываются одним процессом и по порядку. Упавший процесс
+    перезапускается с новой очередью; SIGHUP перезапускает процессы по одному, дожидаясь, пока каждый
+    доделает уже полученные апдейты, и новый процесс продолжает с той же очереди. Ночные задачи выполняет сам supervisor.
+    Если очередь процесса переполнена, апдейт из вебхука получает 503, а апдейт из getUpdates теряется.
+    """
+
+    def __init__(self, processes=WORKER_PROCESSES, queue_size=UPDATE_QUEUE_SIZE):
+        super().__init__(workers=1, queue_size=queue_size)
+        self.processes = max(processes, 1)
+        self._context = multiprocessing.get_context('spawn')
+        self.awaiting_slots = self._context.Array('i', USER_STATE_SLOTS)
+        self.log_queue = self._context.Queue()
+        self._workers = [None] * self.processes  # (процесс, очередь апдейтов)
+        self._restarting = set()
+        self.restarts = 0
+        self.routed = [0] * self.processes
+        self.dropped = [0] * self.processes
+        # общий лимит Telegram делится поровну между процессами-обработчиками и самим supervisor,
+        # который отправляет сообщения ночных задач; лимит чата остаётся целиком у его процесса
+        self.global_rate = OUTBOX_GLOBAL_RATE / (self.processes + 1)
+
+    def start(self):
+        super().start()
+        for user_id in user_states.load():
+            self.awaiting_slots[user_id % USER_STATE_SLOTS] += 1
+        outbox.set_global_rate(self.global_rate)
+        self._log_listener = QueueListener(self.log_queue, log_handler)
+        self._log_listener.start()
+        for index in range(self.processes):
+            self._spawn(index, self._context.Queue(self.queue_size))
+
+    def _spawn(self, index, updates):
+        process = self._context.Process(target=worker_main, name=f'worker-{index}',
+                                        args=(index, updates, self.awaiting_slots, self.log_queue, self.global_rate))
+        process.start()
+        self._workers[index] = (process, updates)
+        root_logger.info(f'worker {index} started, pid {process.pid}')
+
+    def _route(self, raw_update):
+        # без ожидания: переполненная очередь одного процесса не должна задерживать чаты остальных
+        index = update_chat_id(raw_update) % self.processes
+        try:
+            self._workers[index][1].put_nowait(raw_update)
+        except queue.Full:
+            self.dropped[index] += 1
+            self.rejected += 1
+            return False
+        self.routed[index] += 1
+        return True
+
+    def offer(self, raw_update):
+        # вебхук раздаёт апдейты сразу, на 503 Telegram повторит доставку позже
+        return self._route(raw_update)
+
+    async def _dispatch(self, received, raw_update):
+        # getUpdates уже подтвердил апдейт, вернуть его некуда
+        if not self._route(raw_update):
+            root_logger.error(f'worker {update_chat_id(raw_update) % self.processes} queue is full, '
+                              f'update {raw_update.get("update_id")} dropped')
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, (process, updates) in enumerate(self._workers):
+                if index not in self._restarting and not process.is_alive():
+                    # процесс мог умереть, держа блокировку чтения очереди, поэтому очередь заводится новая,
+                    # а не разобранные им апдейты теряются
+                    root_logger.error(f'worker {index} exited with code {process.exitcode}, '
+                                      f'restarting, {updates.qsize()} updates dropped')
+                    self.restarts += 1
+                    self._spawn(index, self._context.Queue(self.queue_size))
+
+    async def restart_worker(self, index):
+        # новый процесс продолжит с той же очереди сразу за None, так что апдейты не теряются
+        self._restarting.add(index)
+        try:
+            process, updates = self._workers[index]
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, updates.put, None)
+            await loop.run_in_executor(None, process.join)
+            self.restarts += 1
+            self._spawn(index, updates)
+        finally:
+            self._restarting.discard(index)
+
+    async def rolling_restart(self):
+        for index in range(self.processes):
+            await self.restart_worker(index)
+
+    def stats(self):
+        # обработчики работают в процессах, поэтому сам supervisor знает только, сколько апдейтов раздал;
+        # обработанные апдейты и задержки обработчиков - в метриках процессов
+        stats = super().stats()
+        del stats['processed']
+        stats['routed'] = sum(self.routed)
+        stats['restarts'] = self.restarts
+        stats['workers'] = [{'pid': process.pid, 'alive': process.is_alive(), 'routed': self.routed[index],
+                             'dropped': self.dropped[index], 'queued': updates.qsize()}
+                            for index, (process, updates) in enumerate(self._workers)]
+        return stats
+
+    async def drain(self, dispatcher, deadline):
+        await self._queue.put(None)
+        await dispatcher
+        self._restarting.update(range(self.processes))
+        loop = asyncio.get_running_loop()
+        for process, updates in self._workers:
+            await loop.run_in_executor(None, updates.put, None)
+        for index, (process, updates) in enumerate(self._workers):
+            # процесс отсчитывает свой срок с получения None, чуть позже supervisor, отсюда секунда запаса
+            await loop.run_in_executor(None, process.join, max(deadline + 1 - time.monotonic(), 0))
+            if process.is_alive():
+                root_logger.error(f'worker {index} did not stop in time, killed')
+                process.kill()  # SIGTERM процесс игнорирует
+        self._executor.shutdown(wait=True)
+        self._log_listener.stop()
+
+
+def run_supervisor(intake):
+    supervisor = Supervisor()
+    REGISTRY.gauge('updates', 'Очередь апдейтов supervisor', lambda: {
+        key: value for key, value in supervisor.stats().items() if not isinstance(value, (dict, list))},
+                   labelname='stat')
+
+    async def main():
+        supervisor.start()
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(supervisor.rolling_restart()))
+        dispatcher = asyncio.ensure_future(supervisor.dispatcher())
+        watcher = asyncio.ensure_future(supervisor.watch())
+        try:
+            if intake == 'webhook':
+                await supervisor.serve_webhook()
+            else:
+                await supervisor.poll()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # повторный SIGTERM не должен отменить и сам drain, а без обработчика он завершил бы процесс
+            loop.remove_signal_handler(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            watcher.cancel()
+            # сообщения ночных задач supervisor отправляет сам, пока процессы доделывают свои;
+            # на всё вместе один срок, чтобы успеть до SIGKILL от Heroku
+            deadline = time.monotonic() + OUTBOX_DRAIN_TIMEOUT
+            flush = loop.run_in_executor(None, flush_on_exit, OUTBOX_DRAIN_TIMEOUT)
+            await supervisor.drain(dispatcher, deadline)
+            await flush
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-assets':
+        assets.build()
+        sys.exit()
+    init_db()
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill-counters':
+        with db_engine.cursor() as cur:
+            backfill_counters(cur)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'prewarm-media':
+        # чат для загрузки: аргумент или MEDIA_CACHE_CHAT_ID, удобно завести для этого служебный канал
+        media_cache.prewarm(int(sys.argv[2] if len(sys.argv) > 2 else os.getenv('MEDIA_CACHE_CHAT_ID')))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'missed-days':
+        # без даты - догнать все необработанные дни, с датой ГГГГ-ММ-ДД - пересчитать этот день
+        if len(sys.argv) > 2:
+            penalize_missed_day(datetime.strptime(sys.argv[2], '%Y-%m-%d').date())
+        else:
+            scheduler.run_due(names=('missed_day',))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'refresh-stats':
+        refresh_chat_stats()
+    else:
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+        if SCHEDULER_ENABLED:
+            scheduler.start()
+        if STATS_REFRESH_INTERVAL:
+            stats_refresher.start()
+        if BOT_RUNTIME == 'supervisor':
+            run_supervisor(SUPERVISOR_INTAKE)
+        elif BOT_RUNTIME in ('asyncio', 'webhook'):
+            run_async(BOT_RUNTIME)
+        else:
+            run_polling()
@@ -0,0 +1,101 @@
+"""Нагрузочный генератор для вебхука health_bot.
+
+Шлёт синтетические апдейты (/check, фото, /stat, /gift, /love, /plan) на вебхук и по /<токен>/stats бота
+снимает p50/p99 задержки обработчиков и пиковую пропускную способность.
+
+Пример:
+    BOT_RUNTIME=webhook PORT=8443 python health_bot.py
+    python load_generator.py --url http://localhost:8443 --token $HEALTH_TOKEN --updates 2000
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+import numpy as np
+
+COMMANDS = ['/check', None, '/stat', '/gift', '/love', '/plan', '/help']  # None - загрузка фото
+WEIGHTS = [3, 3, 2, 1, 1, 1, 1]
+
+
+def make_update(update_id, user_id, chat_id, command):
+    message = {'message_id': update_id,
+               'from': {'id': user_id, 'is_bot': False, 'first_name': f'Load{user_id}', 'username': f'load{user_id}'},
+               'chat': {'id': chat_id, 'type': 'group', 'title': 'load test'},
+               'date': int(time.time())}
+    if command is None:
+        message['photo'] = [{'file_id': 'load', 'file_unique_id': 'load', 'width': 1, 'height': 1}]
+    else:
+        message['text'] = command
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': update_id, 'message': message}
+
+
+async def fetch_stats(session, url, token):
+    async with session.get(url + '/' + token + '/stats') as resp:
+        return await resp.json()
+
+
+async def run(args):
+    rnd = random.Random(args.seed)
+    first_id = int(time.time() * 1000)
+    updates = []
+    for i in range(args.updates):
+        user_id = rnd.randrange(args.users) + 1
+        chat_id = -(user_id % args.chats + 1)
+        updates.append(make_update(first_id + i, user_id, chat_id, rnd.choices(COMMANDS, WEIGHTS)[0]))
+
+    accept_latencies = []
+    statuses = {}
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async with aiohttp.ClientSession() as session:
+        before = await fetch_stats(session, args.url, args.token)
+
+        async def sender():
+            while not queue.empty():
+                update = queue.get_nowait()
+                started = time.monotonic()
+                async with session.post(args.url + '/' + args.token, json=update) as resp:
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                accept_latencies.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        await asyncio.gather(*[sender() for _ in range(args.concurrency)])
+        sent = time.monotonic() - started
+
+        # supervisor сам апдейты не обрабатывает и отдаёт только число розданных процессам
+        counter = 'processed' if 'processed' in before else 'routed'
+        accepted = statuses.get(200, 0)
+        stats = before
+        while stats[counter] - before[counter] < accepted and time.monotonic() - started < args.timeout:
+            await asyncio.sleep(0.2)
+            stats = await fetch_stats(session, args.url, args.token)
+        elapsed = time.monotonic() - started
+
+    done = stats[counter] - before[counter]
+    accept_p50, accept_p99 = np.percentile(accept_latencies, [50, 99]) * 1000
+    print(f'sent {len(updates)} updates in {sent:.2f}s ({len(updates) / sent:.1f} updates/s), statuses {statuses}')
+    print(f'accept latency p50 {accept_p50:.2f} ms, p99 {accept_p99:.2f} ms')
+    print(f'{counter} {done} in {elapsed:.2f}s ({done / elapsed:.1f} updates/s)')
+    if 'handler_latency_p50_ms' in stats:
+        print(f'handler latency p50 {stats["handler_latency_p50_ms"]} ms, p99 {stats["handler_latency_p99_ms"]} ms')
+        print(f'end-to-end latency p50 {stats["latency_p50_ms"]} ms, p99 {stats["latency_p99_ms"]} ms')
+    else:
+        print('handler latency is not measured by this runtime, see the worker metrics')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8443')
+    parser.add_argument('--token', required=True, help='токен бота, он же путь вебхука')
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,206 @@
+"""Метрики health_bot: счётчики, гистограммы и их выдача в текстовом формате Prometheus.
+
+Всё регистрируется в общем REGISTRY. Обработчики оборачиваются декоратором instrument, запросы к базе
+считает DbEngine, остальное (очереди, кэши, пул) отдаётся через gauge с функцией, которая читает
+текущее значение в момент запроса /metrics.
+"""
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+root_logger = logging.getLogger()
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class LatencyHistogram:
+    """Гистограмма времени выполнения с фиксированными границами корзин, в секундах."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина - всё, что дольше buckets[-1]
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return {'count': self.count, 'sum': self.sum, 'buckets': dict(zip(self.buckets + (float('inf'),),
+                                                                                self.counts))}
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, value=1):
+        with self._lock:
+            self.value += value
+
+
+class MetricFamily:
+    """Метрика с метками: labels(...) возвращает (и при первом обращении создаёт) её экземпляр."""
+
+    def __init__(self, name, documentation, kind, labelnames, factory):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = labelnames
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            labels = dict(zip(self.labelnames, values))
+            if self.kind == 'counter':
+                yield self.name, labels, child.value
+            else:
+                snapshot = child.snapshot()
+                cumulative = 0
+                for bound, count in snapshot['buckets'].items():
+                    cumulative += count
+                    yield self.name + '_bucket', dict(labels, le='+Inf' if bound == float('inf') else str(bound)), \
+                        cumulative
+                yield self.name + '_sum', labels, snapshot['sum']
+                yield self.name + '_count', labels, snapshot['count']
+
+
+class Gauge:
+    """Значение, которое читается функцией в момент выдачи метрик.
+
+    Если задан labelname, функция возвращает словарь {значение метки: число}.
+    """
+
+    def __init__(self, name, documentation, function, labelname=None):
+        self.name = name
+        self.documentation = documentation
+        self.kind = 'gauge'
+        self.function = function
+        self.labelname = labelname
+
+    def samples(self):
+        value = self.function()
+        if self.labelname is None:
+            yield self.name, {}, value
+        else:
+            for label, item in value.items():
+                yield self.name, {self.labelname: label}, item
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(MetricFamily(name, documentation, 'counter', labelnames, Counter))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(MetricFamily(name, documentation, 'histogram', labelnames,
+                                           lambda: LatencyHistogram(buckets)))
+
+    def gauge(self, name, documentation, function, labelname=None):
+        return self._register(Gauge(name, documentation, function, labelname))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            try:
+                for name, labels, value in metric.samples():
+                    label_str = ','.join(f'{key}="{_escape(val)}"' for key, val in labels.items())
+                    lines.append(f'{name}{{{label_str}}} {float(value)!r}' if label_str else f'{name} {float(value)!r}')
+            except Exception as e:
+                root_logger.error(f'metric {metric.name} => {e}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+
+HANDLER_REQUESTS = REGISTRY.counter('handler_requests_total', 'Вызовы обработчиков', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter('handler_errors_total', 'Обработчики, завершившиеся исключением', ('handler',))
+HANDLER_SECONDS = REGISTRY.histogram('handler_seconds', 'Время работы обработчика', ('handler',))
+DB_QUERY_SECONDS = REGISTRY.histogram('db_query_seconds', 'Время выполнения именованного запроса', ('statement',))
+DB_QUERY_ERRORS = REGISTRY.counter('db_query_errors_total', 'Запросы, завершившиеся ошибкой', ('statement',))
+
+
+def instrument(function):
+    """Считает вызовы, ошибки и время работы обработчика.
+
+    Ставится под @bot.message_handler, чтобы бот зарегистрировал уже обёрнутую функцию.
+    Исключение не перехватывается, а пробрасывается дальше.
+    """
+    requests = HANDLER_REQUESTS.labels(function.__name__)
+    errors = HANDLER_ERRORS.labels(function.__name__)
+    seconds = HANDLER_SECONDS.labels(function.__name__)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        requests.inc()
+        start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            seconds.observe(time.monotonic() - start)
+
+    return wrapper
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # опрос метрик не должен засорять лог
+
+
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server